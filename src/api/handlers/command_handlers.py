@@ -1,7 +1,4 @@
-from typing import *
-
 from telebot import TeleBot  # telegram bots interaction library
-from telebot.types import *
 
 
 class CommandHandler:
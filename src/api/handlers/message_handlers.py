@@ -1,5 +1,7 @@
+from typing import List, Optional
+
 from telebot import TeleBot  # telegram bots interaction library
-from telebot.types import *
+from telebot.types import BotCommand, Message
 
 from api.services.database_service import DatabaseHandler
 from api.services.spotify_service import SpotifyHandler
@@ -0,0 +1,49 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    def __init__(self, ttl: float, max_entries: int = 1024) -> None:
+        self.ttl: float = ttl
+        self.max_entries: int = max_entries
+        self.entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry: Optional[Tuple[float, Any]] = self.entries.get(key)
+
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at: float = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry: Optional[Tuple[float, Any]] = self.entries.pop(key, None)
+            return entry[1] if entry else None
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
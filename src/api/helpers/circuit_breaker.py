@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import deque
+from typing import Deque
+
+
+class CircuitBreaker:
+    CLOSED: str = "closed"
+    OPEN: str = "open"
+    HALF_OPEN: str = "half_open"
+
+    def __init__(
+        self,
+        failure_rate_threshold: float = 0.5,
+        minimum_calls: int = 10,
+        window_size: int = 20,
+        open_seconds: float = 60,
+        half_open_max_calls: int = 1,
+    ) -> None:
+        self.failure_rate_threshold: float = failure_rate_threshold
+        self.minimum_calls: int = minimum_calls
+        self.open_seconds: float = open_seconds
+        self.half_open_max_calls: int = half_open_max_calls
+        # outcomes of the most recent calls, True for failures
+        self.outcomes: Deque[bool] = deque(maxlen=window_size)
+        self.opened_at: float = 0.0
+        self.half_open_calls: int = 0
+        self.current_state: str = self.CLOSED
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self.lock:
+            return self.__state()
+
+    def __state(self) -> str:
+        if self.current_state == self.OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            self.current_state = self.HALF_OPEN
+            self.half_open_calls = 0
+
+        return self.current_state
+
+    def allow_request(self) -> bool:
+        with self.lock:
+            state: str = self.__state()
+
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and self.half_open_calls < self.half_open_max_calls:
+                self.half_open_calls += 1
+                return True
+
+            return False
+
+    def retry_after(self) -> float:
+        with self.lock:
+            if self.__state() != self.OPEN:
+                return 0.0
+
+            return max(0.0, self.open_seconds - (time.monotonic() - self.opened_at))
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.__state() == self.HALF_OPEN:
+                print("Circuit closed: upstream is responding again")
+                self.current_state = self.CLOSED
+                self.outcomes.clear()
+
+            self.outcomes.append(False)
+
+    def record_failure(self) -> None:
+        with self.lock:
+            state: str = self.__state()
+
+            if state == self.HALF_OPEN:
+                self.__open()
+                return
+
+            self.outcomes.append(True)
+
+            if state == self.CLOSED and len(self.outcomes) >= self.minimum_calls:
+                failure_rate: float = sum(self.outcomes) / len(self.outcomes)
+                if failure_rate >= self.failure_rate_threshold:
+                    self.__open()
+
+    def __open(self) -> None:
+        print(f"Circuit opened: pausing upstream calls for {self.open_seconds:.0f}s")
+        self.current_state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
@@ -0,0 +1,37 @@
+import os
+import threading
+import time
+from collections.abc import Callable
+from typing import List
+
+
+class Heartbeat:
+    def __init__(self, role: str, directory: str = "data/health", interval: float = 30) -> None:
+        self.role: str = role
+        self.path: str = os.path.join(directory, role)
+        self.interval: float = interval
+
+    def beat(self) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w") as heartbeat_file:
+                heartbeat_file.write(str(time.time()))
+        except OSError as e:
+            print(f"Error writing {self.role} heartbeat: {e}")
+
+    def start(self, checks: List[Callable[[], bool]]) -> None:
+        # the heartbeat only keeps ticking while every thread the role depends on is alive
+        def run() -> None:
+            while all(check() for check in checks):
+                self.beat()
+                time.sleep(self.interval)
+
+        threading.Thread(target=run, daemon=True, name=f"{self.role}-heartbeat").start()
+
+
+def heartbeat_is_fresh(role: str, max_age: float, directory: str = "data/health") -> bool:
+    try:
+        with open(os.path.join(directory, role)) as heartbeat_file:
+            return time.time() - float(heartbeat_file.read()) <= max_age
+    except (OSError, ValueError):
+        return False
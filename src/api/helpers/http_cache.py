@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+
+class ValidatorCache:
+    def __init__(self, path: str = "data/http_cache.db", max_age: float = 604800, timeout: float = 30) -> None:
+        # kept apart from the notify database so cache churn never touches it or its backups
+        self.path: str = path
+        self.max_age: float = max_age
+        self.timeout: float = timeout
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+
+    def __connection(self) -> sqlite3.Connection:
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+            self.conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS validators (
+                    key TEXT PRIMARY KEY,
+                    etag TEXT,
+                    body TEXT,
+                    validated_at REAL
+                )
+                """
+            )
+            # entries nobody revalidated in a while belong to playlists nobody tracks anymore
+            self.conn.execute("DELETE FROM validators WHERE validated_at < ?", (time.time() - self.max_age,))
+            self.conn.commit()
+
+        return self.conn
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        try:
+            with self.lock:
+                row: Optional[Tuple[str, str]] = (
+                    self.__connection()
+                    .execute("SELECT etag, body FROM validators WHERE key = ?", (key,))
+                    .fetchone()
+                )
+
+            return row
+        except sqlite3.Error as e:
+            print(f"Error reading the HTTP validator cache: {e}")
+            return None
+
+    def set(self, key: str, etag: str, body: str) -> None:
+        try:
+            with self.lock:
+                conn: sqlite3.Connection = self.__connection()
+                conn.execute(
+                    "INSERT INTO validators (key, etag, body, validated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET etag = excluded.etag, body = excluded.body, validated_at = excluded.validated_at",
+                    (key, etag, body, time.time()),
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error writing the HTTP validator cache: {e}")
+
+    def touch(self, key: str) -> None:
+        try:
+            with self.lock:
+                conn: sqlite3.Connection = self.__connection()
+                conn.execute("UPDATE validators SET validated_at = ? WHERE key = ?", (time.time(), key))
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error writing the HTTP validator cache: {e}")
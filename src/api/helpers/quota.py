@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from typing import Any, Deque, Dict, Optional
+
+
+class QuotaScheduler:
+    INTERACTIVE: str = "interactive"
+    WARMUP: str = "warmup"
+    BACKGROUND: str = "background"
+
+    # share of the quota each lane gets while all of them are waiting
+    WEIGHTS: Dict[str, float] = {INTERACTIVE: 8, WARMUP: 3, BACKGROUND: 1}
+
+    def __init__(self, rate: float = 10, burst: int = 20, demand_window: float = 10) -> None:
+        self.rate: float = rate
+        self.burst: float = burst
+        self.tokens: float = burst
+        self.refilled_at: float = time.monotonic()
+        self.demand_window: float = demand_window
+        self.waiting: Dict[str, int] = {lane: 0 for lane in self.WEIGHTS}
+        # weighted fair sharing: the waiting lane that has been served least for its weight goes next
+        self.virtual_time: Dict[str, float] = {lane: 0.0 for lane in self.WEIGHTS}
+        # where the latest grant started, i.e. how far the busy lanes have got
+        self.virtual_clock: float = 0.0
+        self.interactive_grants: Deque[float] = deque()
+        self.condition = threading.Condition()
+        # each thread works for one lane, the bot's threads are interactive unless told otherwise
+        self.local = threading.local()
+
+    @property
+    def lane(self) -> str:
+        return getattr(self.local, "lane", self.INTERACTIVE)
+
+    @lane.setter
+    def lane(self, lane: str) -> None:
+        self.local.lane = lane
+
+    def bind(self, func: Callable) -> Callable:
+        # carries the caller's lane over to worker threads
+        lane: str = self.lane
+
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            previous: str = self.lane
+            self.lane = lane
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.lane = previous
+
+        return wrapper
+
+    def __refill(self) -> None:
+        now: float = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def __next_lane(self) -> Optional[str]:
+        waiting = [lane for lane, count in self.waiting.items() if count]
+        if not waiting:
+            return None
+
+        return min(waiting, key=lambda lane: (self.virtual_time[lane], -self.WEIGHTS[lane]))
+
+    def acquire(self, lane: Optional[str] = None) -> None:
+        lane = lane or self.lane
+
+        with self.condition:
+            if not self.waiting[lane]:
+                # a lane coming back from idle doesn't get to spend the time it sat out,
+                # one that was just served keeps its place
+                self.virtual_time[lane] = max(self.virtual_time[lane], self.virtual_clock)
+            self.waiting[lane] += 1
+
+            try:
+                while True:
+                    self.__refill()
+
+                    if self.tokens >= 1 and self.__next_lane() == lane:
+                        self.tokens -= 1
+                        self.virtual_clock = self.virtual_time[lane]
+                        self.virtual_time[lane] += 1 / self.WEIGHTS[lane]
+                        if lane == self.INTERACTIVE:
+                            self.interactive_grants.append(time.monotonic())
+                        self.condition.notify_all()
+                        return
+
+                    self.condition.wait(max(1 - self.tokens, 0.1) / self.rate)
+            finally:
+                self.waiting[lane] -= 1
+
+    def interactive_demand(self) -> float:
+        # interactive requests per second over the last demand_window seconds
+        with self.condition:
+            cutoff: float = time.monotonic() - self.demand_window
+            while self.interactive_grants and self.interactive_grants[0] < cutoff:
+                self.interactive_grants.popleft()
+
+            return len(self.interactive_grants) / self.demand_window
+
+    def interactive_busy(self, threshold: float = 0.5) -> bool:
+        with self.condition:
+            waiting: bool = self.waiting[self.INTERACTIVE] > 0
+
+        return waiting or self.interactive_demand() >= self.rate * threshold
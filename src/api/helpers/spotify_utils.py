@@ -1,6 +1,13 @@
 import re
+from typing import List
 
 def extract_spotify_id(url: str) -> str:
     pattern = r"(?:spotify:|https?://open\.spotify\.com/(?:track|album|artist|playlist)/)([a-zA-Z0-9]+)"
     match = re.search(pattern, url)
-    return match.group(1) if match else ""
\ No newline at end of file
+    return match.group(1) if match else ""
+
+
+def extract_spotify_ids(text: str, kind: str = "playlist") -> List[str]:
+    # one pass over the whole message, duplicates dropped but order kept
+    pattern = rf"(?:spotify:{kind}:|https?://open\.spotify\.com/(?:intl-[a-zA-Z-]+/)?{kind}/)([a-zA-Z0-9]+)"
+    return list(dict.fromkeys(re.findall(pattern, text)))
@@ -0,0 +1,34 @@
+import time
+from typing import List, Optional, Tuple
+
+
+class StartupProfile:
+    def __init__(self, started_at: float, enabled: bool = False) -> None:
+        self.started_at: float = started_at
+        self.enabled: bool = enabled
+        self.last_mark: float = started_at
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str, at: Optional[float] = None) -> float:
+        now: float = time.perf_counter() if at is None else at
+        duration_ms: float = (now - self.last_mark) * 1000
+        self.phases.append((phase, duration_ms))
+        self.last_mark = now
+
+        if self.enabled:
+            print(f"Startup: {phase} took {duration_ms:.1f}ms")
+
+        return duration_ms
+
+    def check_budget(self, phase: str, budget_ms: float) -> bool:
+        for name, duration_ms in self.phases:
+            if name == phase and duration_ms > budget_ms:
+                print(f"Startup: {phase} took {duration_ms:.1f}ms, over its {budget_ms:.0f}ms budget")
+                return False
+
+        return True
+
+    def report(self) -> None:
+        if self.enabled:
+            total_ms: float = (self.last_mark - self.started_at) * 1000
+            print(f"Startup: ready after {total_ms:.1f}ms")
@@ -0,0 +1,21 @@
+from typing import Iterable, List
+
+MESSAGE_LIMIT: int = 4096
+
+
+def chunk_lines(lines: Iterable[str], header: str = "", limit: int = MESSAGE_LIMIT) -> List[str]:
+    # splits only between lines so HTML tags are never cut in half
+    chunks: List[str] = []
+    current: str = header
+
+    for line in lines:
+        line = line[:limit]
+        if current and len(current) + len(line) + 1 > limit:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+
+    if current:
+        chunks.append(current)
+
+    return chunks
@@ -0,0 +1,184 @@
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+
+class Span:
+    def __init__(self, name: str, parent: Optional["Span"] = None, **attrs: Any) -> None:
+        self.name: str = name
+        self.parent: Optional[Span] = parent
+        self.attrs: Dict[str, Any] = attrs
+        self.children: List[Span] = []
+        self.start: float = time.perf_counter()
+        self.end: Optional[float] = None
+        self.error: Optional[str] = None
+
+        if parent is not None:
+            parent.children.append(self)
+
+    @property
+    def duration_ms(self) -> float:
+        end: float = self.end if self.end is not None else time.perf_counter()
+        return (end - self.start) * 1000
+
+    def render(self, depth: int = 0) -> str:
+        attrs: str = " ".join(f"{key}={val}" for key, val in self.attrs.items())
+        line: str = f"{'  ' * depth}{self.name} {self.duration_ms:.1f}ms"
+        if attrs:
+            line += f" [{attrs}]"
+        if self.error:
+            line += f" !{self.error}"
+
+        lines: List[str] = [line]
+        for child in self.children:
+            lines.append(child.render(depth + 1))
+
+        return "\n".join(lines)
+
+
+class Tracer:
+    def __init__(
+        self,
+        slow_threshold_ms: float = 2000,
+        profile_sample_rate: float = 0.0,
+        profile_dir: str = "data/profiles",
+    ) -> None:
+        self.slow_threshold_ms: float = slow_threshold_ms
+        self.profile_sample_rate: float = profile_sample_rate
+        self.profile_dir: str = profile_dir
+        self.local = threading.local()
+        # cProfile can only have one active profiler per process
+        self.profile_lock = threading.Lock()
+
+    def configure(
+        self,
+        slow_threshold_ms: Optional[float] = None,
+        profile_sample_rate: Optional[float] = None,
+        profile_dir: Optional[str] = None,
+    ) -> None:
+        if slow_threshold_ms is not None:
+            self.slow_threshold_ms = slow_threshold_ms
+        if profile_sample_rate is not None:
+            self.profile_sample_rate = profile_sample_rate
+        if profile_dir is not None:
+            self.profile_dir = profile_dir
+
+    def current(self) -> Optional[Span]:
+        return getattr(self.local, "span", None)
+
+    @contextmanager
+    def span(self, name: str, **attrs: Any) -> Iterator[Optional[Span]]:
+        parent: Optional[Span] = self.current()
+
+        # spans outside of a trace are not recorded
+        if parent is None:
+            yield None
+            return
+
+        span: Span = Span(name, parent, **attrs)
+        self.local.span = span
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.end = time.perf_counter()
+            self.local.span = parent
+
+    @contextmanager
+    def trace(self, name: str, **attrs: Any) -> Iterator[Span]:
+        # nested traces become regular spans of the enclosing one
+        if self.current() is not None:
+            with self.span(name, **attrs) as span:
+                yield span
+            return
+
+        root: Span = Span(name, **attrs)
+        profiler: Optional[cProfile.Profile] = self.__start_profiler()
+        self.local.span = root
+        try:
+            yield root
+        except BaseException as e:
+            root.error = type(e).__name__
+            raise
+        finally:
+            root.end = time.perf_counter()
+            self.local.span = None
+            if profiler is not None:
+                self.__stop_profiler(profiler, name)
+            if root.duration_ms >= self.slow_threshold_ms:
+                print(f"Slow trace ({root.duration_ms:.1f}ms):\n{root.render()}")
+
+    def bind(self, func: Callable) -> Callable:
+        # carries the caller's span over to worker threads
+        parent: Optional[Span] = self.current()
+
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            previous: Optional[Span] = self.current()
+            self.local.span = parent
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.local.span = previous
+
+        return wrapper
+
+    def traced(self, name: Optional[str] = None) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            span_name: str = name or func.__qualname__
+
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+
+            wrapper.__name__ = func.__name__
+            wrapper.__qualname__ = func.__qualname__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+
+        return decorator
+
+    def __start_profiler(self) -> Optional[cProfile.Profile]:
+        if self.profile_sample_rate <= 0 or random.random() >= self.profile_sample_rate:
+            return None
+        if not self.profile_lock.acquire(blocking=False):
+            return None
+
+        profiler: cProfile.Profile = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is already active in this process
+            self.profile_lock.release()
+            return None
+
+        return profiler
+
+    def __stop_profiler(self, profiler: cProfile.Profile, name: str) -> None:
+        try:
+            profiler.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            file_name: str = f"{name.replace('/', '_')}-{time.strftime('%Y%m%d-%H%M%S')}-{threading.get_ident()}.prof"
+            profiler.dump_stats(os.path.join(self.profile_dir, file_name))
+        except OSError as e:
+            print(f"Error writing profile: {e}")
+        finally:
+            self.profile_lock.release()
+
+
+tracer: Tracer = Tracer()
+
+
+def traced_telegram_sender(method: str, url: str, **kwargs: Any) -> Any:
+    # plugged into telebot's apihelper.CUSTOM_REQUEST_SENDER so every bot API call gets a span
+    from telebot import apihelper
+
+    api_method: str = url.rsplit("/", 1)[-1]
+
+    with tracer.span(f"telegram.{api_method}"):
+        return apihelper._get_req_session().request(method, url, **kwargs)
@@ -0,0 +1,93 @@
+import sys
+import threading
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple, Union
+
+from api.models.spotify_models import ArtistRef, TrackRef
+
+CatalogRecord = Union[TrackRef, ArtistRef]
+
+
+def record_size(record: CatalogRecord) -> int:
+    # a rough estimate, enough to keep the catalog under its cap
+    size: int = sys.getsizeof(record) + sum(
+        sys.getsizeof(value) for value in (record.id, record.name, record.url)
+    )
+
+    if isinstance(record, ArtistRef):
+        size += sys.getsizeof(record.genres) + sum(sys.getsizeof(genre) for genre in record.genres)
+    else:
+        # the artists themselves are catalog entries of their own
+        size += sys.getsizeof(record.artists)
+
+    return size
+
+
+class Catalog:
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024) -> None:
+        self.max_bytes: int = max_bytes
+        self.size: int = 0
+        # Spotify IDs are unique enough across types to share one LRU
+        self.records: "OrderedDict[str, Tuple[CatalogRecord, int]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __add(self, record: CatalogRecord) -> CatalogRecord:
+        entry: Optional[Tuple[CatalogRecord, int]] = self.records.get(record.id)
+
+        if entry is not None:
+            existing: CatalogRecord = entry[0]
+            # artists nested in tracks come without genres, keep the richer copy
+            if not (isinstance(record, ArtistRef) and record.genres and not existing.genres):
+                self.records.move_to_end(record.id)
+                return existing
+            self.size -= entry[1]
+
+        size: int = record_size(record)
+        self.records[record.id] = (record, size)
+        self.records.move_to_end(record.id)
+        self.size += size
+
+        while self.size > self.max_bytes and len(self.records) > 1:
+            _, (_, evicted_size) = self.records.popitem(last=False)
+            self.size -= evicted_size
+
+        return record
+
+    def add_artist(self, artist: ArtistRef) -> ArtistRef:
+        with self.lock:
+            return self.__add(artist)
+
+    def add_track(self, track: TrackRef) -> TrackRef:
+        with self.lock:
+            # the track points at the shared artist records, not at its own copies
+            artists: Tuple[ArtistRef, ...] = tuple(self.__add(artist) for artist in track.artists)
+            if any(shared is not own for shared, own in zip(artists, track.artists)):
+                track = TrackRef(id=track.id, name=track.name, url=track.url, artists=artists)
+
+            return self.__add(track)
+
+    def add_tracks(self, tracks: Iterable[TrackRef]) -> Tuple[str, ...]:
+        return tuple(self.add_track(track).id for track in tracks)
+
+    def add_artists(self, artists: Iterable[ArtistRef]) -> Tuple[str, ...]:
+        return tuple(self.add_artist(artist).id for artist in artists)
+
+    def get(self, ids: Iterable[str]) -> List[CatalogRecord]:
+        # records evicted since the IDs were handed out are left out
+        with self.lock:
+            records: List[CatalogRecord] = []
+
+            for record_id in ids:
+                entry: Optional[Tuple[CatalogRecord, int]] = self.records.get(record_id)
+                if entry is not None:
+                    self.records.move_to_end(record_id)
+                    records.append(entry[0])
+
+            return records
+
+    def contains_all(self, ids: Iterable[str]) -> bool:
+        with self.lock:
+            return all(record_id in self.records for record_id in ids)
@@ -0,0 +1,64 @@
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+
+def spotify_url(data: Dict[str, Any]) -> str:
+    return (data.get("external_urls") or {}).get("spotify", "")
+
+
+@dataclass(frozen=True, slots=True)
+class ArtistRef:
+    id: str
+    name: str
+    url: str
+    genres: Tuple[str, ...] = ()
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ArtistRef":
+        return cls(
+            id=data.get("id") or "",
+            name=data.get("name") or "",
+            url=spotify_url(data),
+            genres=tuple(data.get("genres") or ()),
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class TrackRef:
+    id: str
+    name: str
+    url: str
+    artists: Tuple[ArtistRef, ...] = ()
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "TrackRef":
+        return cls(
+            id=data.get("id") or "",
+            name=data.get("name") or "",
+            url=spotify_url(data),
+            artists=tuple(ArtistRef.from_dict(artist) for artist in data.get("artists") or ()),
+        )
+
+    @property
+    def artist(self) -> Optional[ArtistRef]:
+        return self.artists[0] if self.artists else None
+
+
+@dataclass(frozen=True, slots=True)
+class PlaylistSummary:
+    id: str
+    name: str
+    url: str
+    snapshot_id: str
+
+    # the only fields Notify reads, also handy as the fields filter of playlist requests
+    FIELDS = "id,name,snapshot_id,external_urls"
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "PlaylistSummary":
+        return cls(
+            id=data.get("id") or "",
+            name=data.get("name") or "",
+            url=spotify_url(data),
+            snapshot_id=data.get("snapshot_id") or "",
+        )
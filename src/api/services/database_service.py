@@ -1,18 +1,125 @@
 import os
 import sqlite3
 import threading
+import time
 from collections.abc import Callable
-from typing import *
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from api.helpers.tracing import tracer
+
+
+class BatchWriter:
+    def __init__(self, database: "DatabaseHandler", batch_size: int) -> None:
+        self.database: DatabaseHandler = database
+        self.batch_size: int = max(1, batch_size)
+        self.snapshot_updates: List[Tuple[str, int, str]] = []
+        self.access_tokens: List[Tuple[str, Optional[float], int]] = []
+        self.checked_playlists: List[Tuple[float, int, str]] = []
+        self.missed_playlists: List[Tuple[float, int, str]] = []
+        self.deactivated_notify: List[Tuple[int, str]] = []
+        self.callbacks: List[Callable[[], Any]] = []
+
+    def __len__(self) -> int:
+        return (
+            len(self.snapshot_updates)
+            + len(self.access_tokens)
+            + len(self.checked_playlists)
+            + len(self.missed_playlists)
+            + len(self.deactivated_notify)
+        )
+
+    def __enter__(self) -> "BatchWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # writes queued before an error are still valid, so flush them anyway
+        self.flush()
+
+    def __queued(self) -> None:
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def update_notify_snapshot(self, telegram_user_id: int, playlist_id: str, snapshot_id: str) -> None:
+        self.snapshot_updates.append((snapshot_id, telegram_user_id, playlist_id))
+        self.__queued()
+
+    def store_access_token(self, access_token: str, user: int, expires_at: Optional[float] = None) -> None:
+        self.access_tokens.append((access_token, expires_at, user))
+        self.__queued()
+
+    def mark_checked(self, telegram_user_id: int, playlist_id: str, checked_at: float) -> None:
+        self.checked_playlists.append((checked_at, telegram_user_id, playlist_id))
+        self.__queued()
+
+    def record_miss(self, telegram_user_id: int, playlist_id: str, checked_at: float) -> None:
+        self.missed_playlists.append((checked_at, telegram_user_id, playlist_id))
+        self.__queued()
+
+    def deactivate_notify(self, telegram_user_id: int, playlist_id: str) -> None:
+        self.deactivated_notify.append((telegram_user_id, playlist_id))
+        self.__queued()
+
+    def after_flush(self, callback: Callable[[], Any]) -> None:
+        # runs once the writes queued so far are committed
+        self.callbacks.append(callback)
+
+    def flush(self) -> None:
+        if not len(self):
+            self.__run_callbacks()
+            return
+
+        snapshot_updates, self.snapshot_updates = self.snapshot_updates, []
+        access_tokens, self.access_tokens = self.access_tokens, []
+        checked_playlists, self.checked_playlists = self.checked_playlists, []
+        missed_playlists, self.missed_playlists = self.missed_playlists, []
+        deactivated_notify, self.deactivated_notify = self.deactivated_notify, []
+
+        def logic() -> None:
+            self.database.cursor.executemany(
+                "UPDATE users SET access_token = ?, token_expires_at = ? WHERE telegram_user_id = ?",
+                access_tokens,
+            )
+            self.database.cursor.executemany(
+                "UPDATE notify SET snapshot_id = ? WHERE telegram_user_id = ? AND playlist_id = ?",
+                snapshot_updates,
+            )
+            self.database.cursor.executemany(
+                "UPDATE notify SET last_checked_at = ?, missed_checks = 0 WHERE telegram_user_id = ? AND playlist_id = ?",
+                checked_playlists,
+            )
+            self.database.cursor.executemany(
+                "UPDATE notify SET last_checked_at = ?, missed_checks = missed_checks + 1 WHERE telegram_user_id = ? AND playlist_id = ?",
+                missed_playlists,
+            )
+            self.database.cursor.executemany(
+                "UPDATE notify SET active = 0 WHERE telegram_user_id = ? AND playlist_id = ?",
+                deactivated_notify,
+            )
+
+        self.database.process(logic)
+        self.__run_callbacks()
+
+    def __run_callbacks(self) -> None:
+        callbacks, self.callbacks = self.callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Error running batch callback: {e}")
 
 
 class DatabaseHandler:
-    def __init__(self, database: str) -> None:
+    def __init__(self, database: str, batch_size: int = 50, timeout: float = 30) -> None:
         self.database: str = f"data/{database}"
         self.backup: str = "data/backup.db"
         self.conn: sqlite3.Connection = None
         self.backup_conn: sqlite3.Connection = None
         self.cursor: sqlite3.Cursor = None
         self.databases: bool = False
+        self.batch_size: int = batch_size
+        # how long to wait on locks held by the other notify processes
+        self.timeout: float = timeout
         self.lock = threading.Lock()
 
     def __do_nothing(self) -> None:
@@ -22,7 +129,7 @@ class DatabaseHandler:
         try:
             os.makedirs(os.path.dirname(self.database), exist_ok=True)
 
-            self.conn = sqlite3.connect(self.database)
+            self.conn = sqlite3.connect(self.database, timeout=self.timeout)
             self.cursor = self.conn.cursor()
 
         except sqlite3.Error as e:
@@ -31,9 +138,11 @@ class DatabaseHandler:
     def __disconnect(self) -> None:
         try:
             self.conn.commit()
-            self.backup_conn = sqlite3.connect(self.backup)
-            self.conn.backup(self.backup_conn)
-            self.backup_conn.close()
+            # read-only work has nothing new to back up
+            if self.conn.total_changes > 0:
+                self.backup_conn = sqlite3.connect(self.backup)
+                self.conn.backup(self.backup_conn)
+                self.backup_conn.close()
         except sqlite3.Error as e:
             print(f"Error commiting changes: {e}")
         self.cursor.close()
@@ -43,14 +152,33 @@ class DatabaseHandler:
         if func is None:
             self.__do_nothing()
         else:
-            with self.lock:
-                self.__connect()
-                result = func()
-                self.__disconnect()
+            name: str = func.__qualname__.split(".<locals>")[0].split(".")[-1]
+
+            with tracer.span(f"db.{name}"):
+                with tracer.span("db.lock_wait"):
+                    self.lock.acquire()
+                try:
+                    self.__connect()
+                    result = func()
+                    self.__disconnect()
+                finally:
+                    self.lock.release()
             return result
-        
+
+    def batch(self, batch_size: Optional[int] = None) -> BatchWriter:
+        return BatchWriter(self, batch_size or self.batch_size)
+
     def create_tables(self) -> None:
         def logic() -> None:
+            # WAL lets the bot, web and poller processes read while one of them writes
+            try:
+                self.cursor.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.OperationalError as e:
+                # switching modes doesn't wait for the busy timeout, but the mode sticks to
+                # the file, so the process holding the lock or the next start sets it
+                print(f"Error switching database to WAL mode: {e}")
+            # the processes start together, so only one of them may look at and change the schema at a time
+            self.cursor.execute("BEGIN IMMEDIATE")
             self.cursor.execute(
                 """
                 CREATE TABLE IF NOT EXISTS users (
@@ -74,6 +202,85 @@ class DatabaseHandler:
                 )
                 """
             )
+            self.cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+                """
+            )
+            self.cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS warmup_queue (
+                    telegram_user_id INTEGER PRIMARY KEY,
+                    requested_at REAL
+                )
+                """
+            )
+            self.__add_missing_columns(
+                "users",
+                {"delivery_mode": "TEXT DEFAULT 'immediate'", "active": "INTEGER DEFAULT 1", "token_expires_at": "REAL", "inactive_reason": "TEXT"},
+            )
+            self.__add_missing_columns(
+                "notify",
+                {"last_checked_at": "REAL", "missed_checks": "INTEGER DEFAULT 0", "active": "INTEGER DEFAULT 1"},
+            )
+        self.process(logic)
+
+    def __add_missing_columns(self, table: str, columns: Dict[str, str]) -> None:
+        # CREATE TABLE IF NOT EXISTS leaves tables from older versions untouched
+        self.cursor.execute(f"PRAGMA table_info({table})")
+        existing: Set[str] = {row[1] for row in self.cursor.fetchall()}
+
+        for column, definition in columns.items():
+            if column not in existing:
+                self.cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def get_meta(self, key: str) -> Optional[str]:
+        def logic() -> Optional[str]:
+            self.cursor.execute("SELECT value FROM meta WHERE key = ?", (key,))
+            row: Optional[Tuple[str]] = self.cursor.fetchone()
+
+            return row[0] if row else None
+
+        return self.process(logic)
+
+    def set_meta(self, key: str, value: str) -> None:
+        def logic() -> None:
+            self.cursor.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, value),
+            )
+
+        self.process(logic)
+
+    def add_user(
+        self,
+        telegram_user_id: int,
+        spotify_user_display: str,
+        spotify_user_id: str,
+        refresh_token: str,
+        access_token: str,
+        token_expires_at: Optional[float] = None,
+    ) -> None:
+        def logic() -> None:
+            self.cursor.execute(
+                """
+                INSERT INTO users (telegram_user_id, spotify_user_display, spotify_user_id, refresh_token, access_token, token_expires_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(telegram_user_id) DO UPDATE SET
+                    spotify_user_display = excluded.spotify_user_display,
+                    spotify_user_id = excluded.spotify_user_id,
+                    refresh_token = excluded.refresh_token,
+                    access_token = excluded.access_token,
+                    token_expires_at = excluded.token_expires_at,
+                    active = 1,
+                    inactive_reason = NULL
+                """,
+                (telegram_user_id, spotify_user_display, spotify_user_id, refresh_token, access_token, token_expires_at),
+            )
+
         self.process(logic)
 
     def user_exists(self, user: int) -> bool:
@@ -91,12 +298,54 @@ class DatabaseHandler:
 
         return self.process(logic)
 
+    def get_user_state(self, user: int) -> Optional[Tuple[bool, Optional[str]]]:
+        # whether the user is active and why they were paused, None if they aren't registered
+        def logic() -> Optional[Tuple[bool, Optional[str]]]:
+            self.cursor.execute(
+                "SELECT COALESCE(active, 1), inactive_reason FROM users WHERE telegram_user_id = ?",
+                (user,),
+            )
+            row: Optional[Tuple[int, Optional[str]]] = self.cursor.fetchone()
+
+            if row is None:
+                return None
+
+            return bool(row[0]), row[1]
+
+        return self.process(logic)
+
+    def deactivate_user(self, user: int, reason: str) -> None:
+        # the poller skips inactive users until they come back,
+        # reason is "blocked" when Telegram refused delivery and "revoked" when Spotify did
+        def logic() -> None:
+            self.cursor.execute(
+                "UPDATE users SET active = 0, inactive_reason = ? WHERE telegram_user_id = ?",
+                (reason, user),
+            )
+
+        self.process(logic)
+
+    def reactivate_user(self, user: int) -> None:
+        # only a block can be undone from the chat, a revoked token needs a new login
+        def logic() -> None:
+            self.cursor.execute(
+                "UPDATE users SET active = 1, inactive_reason = NULL WHERE telegram_user_id = ? AND active = 0 AND inactive_reason = 'blocked'",
+                (user,),
+            )
+
+        self.process(logic)
+
     def delete_user(self, user: int) -> None:
         def logic() -> None:
             self.cursor.execute(
                 "DELETE FROM users WHERE telegram_user_id = ?",
                 (user,),
             )
+            # foreign keys aren't enforced, so the subscriptions have to go explicitly
+            self.cursor.execute(
+                "DELETE FROM notify WHERE telegram_user_id = ?",
+                (user,),
+            )
 
         self.process(logic)
 
@@ -120,15 +369,88 @@ class DatabaseHandler:
 
         return self.process(logic)
 
-    def store_access_token(self, access_token: str, user: int) -> None:
+    def get_tokens(self, user: int) -> Tuple[Optional[str], Optional[str], Optional[float]]:
+        def logic() -> Tuple[Optional[str], Optional[str], Optional[float]]:
+            self.cursor.execute(
+                "SELECT access_token, refresh_token, token_expires_at FROM users WHERE telegram_user_id = ?",
+                (user,),
+            )
+
+            return self.cursor.fetchone() or (None, None, None)
+
+        return self.process(logic)
+
+    def fetch_expiring_tokens(self, expires_before: float, limit: int) -> List[Tuple[int, str]]:
+        # tokens stored before expiry times were recorded come first
+        def logic() -> List[Tuple[int, str]]:
+            self.cursor.execute(
+                """
+                SELECT telegram_user_id, refresh_token FROM users
+                WHERE COALESCE(active, 1) = 1
+                    AND refresh_token IS NOT NULL
+                    AND (token_expires_at IS NULL OR token_expires_at < ?)
+                ORDER BY token_expires_at
+                LIMIT ?
+                """,
+                (expires_before, limit),
+            )
+            return self.cursor.fetchall()
+
+        return self.process(logic)
+
+    def store_access_token(self, access_token: str, user: int, expires_at: Optional[float] = None) -> None:
+        def logic() -> None:
+            self.cursor.execute(
+                "UPDATE users SET access_token = ?, token_expires_at = ? WHERE telegram_user_id = ?",
+                (access_token, expires_at, user),
+            )
+
+        self.process(logic)
+
+    def get_delivery_mode(self, user: int) -> str:
+        def logic() -> str:
+            self.cursor.execute(
+                "SELECT delivery_mode FROM users WHERE telegram_user_id = ?", (user,)
+            )
+            row: Optional[Tuple[str]] = self.cursor.fetchone()
+
+            return row[0] if row and row[0] else "immediate"
+
+        return self.process(logic)
+
+    def set_delivery_mode(self, user: int, delivery_mode: str) -> None:
         def logic() -> None:
             self.cursor.execute(
-                "UPDATE users SET access_token = ? WHERE telegram_user_id = ?",
-                (access_token, user),
+                "UPDATE users SET delivery_mode = ? WHERE telegram_user_id = ?",
+                (delivery_mode, user),
             )
 
         self.process(logic)
 
+    def queue_warmup(self, user: int) -> None:
+        def logic() -> None:
+            self.cursor.execute(
+                "INSERT OR REPLACE INTO warmup_queue (telegram_user_id, requested_at) VALUES (?, ?)",
+                (user, time.time()),
+            )
+
+        self.process(logic)
+
+    def pop_warmup_requests(self) -> List[Tuple[int, str]]:
+        def logic() -> List[Tuple[int, str]]:
+            self.cursor.execute(
+                """
+                SELECT warmup_queue.telegram_user_id, users.access_token FROM warmup_queue
+                JOIN users ON users.telegram_user_id = warmup_queue.telegram_user_id
+                """
+            )
+            requests: List[Tuple[int, str]] = self.cursor.fetchall()
+            self.cursor.execute("DELETE FROM warmup_queue")
+
+            return requests
+
+        return self.process(logic)
+
     def fetch_telegram_users(self) -> List[int]:
         def logic() -> List[int]:
             self.cursor.execute("SELECT telegram_user_id FROM users")
@@ -137,10 +459,29 @@ class DatabaseHandler:
         return self.process(logic)
 
     def add_notify(self, telegram_user_id: int, playlist_id: str, snapshot_id: str) -> None:
+        self.add_notify_many(telegram_user_id, [(playlist_id, snapshot_id)])
+
+    def add_notify_many(self, telegram_user_id: int, playlists: List[Tuple[str, str]]) -> None:
         def logic() -> None:
-            self.cursor.execute(
-                "INSERT INTO notify (telegram_user_id, playlist_id, snapshot_id) VALUES (?, ?, ?)",
-                (telegram_user_id, playlist_id, snapshot_id),
+            for playlist_id, snapshot_id in playlists:
+                # tracking a playlist again brings back its deactivated subscription
+                self.cursor.execute(
+                    "UPDATE notify SET snapshot_id = ?, missed_checks = 0, active = 1 WHERE telegram_user_id = ? AND playlist_id = ?",
+                    (snapshot_id, telegram_user_id, playlist_id),
+                )
+                if self.cursor.rowcount == 0:
+                    self.cursor.execute(
+                        "INSERT INTO notify (telegram_user_id, playlist_id, snapshot_id) VALUES (?, ?, ?)",
+                        (telegram_user_id, playlist_id, snapshot_id),
+                    )
+
+        self.process(logic)
+
+    def delete_notify_many(self, telegram_user_id: int, playlists_ids: List[str]) -> None:
+        def logic() -> None:
+            self.cursor.executemany(
+                "DELETE FROM notify WHERE telegram_user_id = ? AND playlist_id = ?",
+                [(telegram_user_id, playlist_id) for playlist_id in playlists_ids],
             )
 
         self.process(logic)
@@ -166,7 +507,7 @@ class DatabaseHandler:
     def playlist_exists(self, telegram_user_id: int, playlist_id: str) -> bool:
         def logic() -> bool:
             self.cursor.execute(
-                "SELECT id FROM notify WHERE telegram_user_id = ? AND playlist_id = ?",
+                "SELECT id FROM notify WHERE telegram_user_id = ? AND playlist_id = ? AND active = 1",
                 (telegram_user_id, playlist_id,),
             )
             notify_id: int = self.cursor.fetchone()
@@ -181,25 +522,59 @@ class DatabaseHandler:
     def get_notify_playlists_by_user(self, telegram_user_id: int) -> List[str]:
         def logic() -> List[str]:
             self.cursor.execute(
-                "SELECT playlist_id FROM notify WHERE telegram_user_id = ?", (telegram_user_id,)
+                "SELECT playlist_id FROM notify WHERE telegram_user_id = ? AND active = 1", (telegram_user_id,)
             )
             return [row[0] for row in self.cursor.fetchall()]
 
         return self.process(logic)
 
-    def update_notify_snapshot(self, telegram_user_id: int, playlist_id: str, snapshot_id: str) -> None:
-        def logic() -> None:
+    def fetch_poll_items(self, cycle_started_at: float) -> List[Tuple[int, str, str, str, int]]:
+        # playlists already checked in this cycle are skipped when a cycle is resumed,
+        # inactive users, users without a refresh token and inactive subscriptions aren't polled at all
+        def logic() -> List[Tuple[int, str, str, str, int]]:
             self.cursor.execute(
-                "UPDATE notify SET snapshot_id = ? WHERE telegram_user_id = ? AND playlist_id = ?", (snapshot_id, telegram_user_id, playlist_id)
+                """
+                SELECT notify.telegram_user_id, notify.playlist_id, notify.snapshot_id,
+                    COALESCE(users.delivery_mode, 'immediate'), COALESCE(notify.missed_checks, 0)
+                FROM notify
+                JOIN users ON users.telegram_user_id = notify.telegram_user_id
+                WHERE notify.active = 1
+                    AND COALESCE(users.active, 1) = 1
+                    AND users.refresh_token IS NOT NULL
+                    AND (notify.last_checked_at IS NULL OR notify.last_checked_at < ?)
+                ORDER BY notify.telegram_user_id, notify.playlist_id
+                """,
+                (cycle_started_at,),
             )
+            return self.cursor.fetchall()
 
-        self.process(logic)
+        return self.process(logic)
 
-    def get_notify_snapshot(self, telegram_user_id: int, playlist_id: str) -> str:
-        def logic() -> str:
+    def get_poll_cursor(self) -> Tuple[Optional[float], Optional[float]]:
+        def logic() -> Tuple[Optional[float], Optional[float]]:
             self.cursor.execute(
-                "SELECT snapshot_id FROM notify WHERE telegram_user_id = ? AND playlist_id = ?", (telegram_user_id, playlist_id,)
+                "SELECT key, value FROM meta WHERE key IN ('poll_cycle_started_at', 'poll_cycle_finished_at')"
             )
-            return self.cursor.fetchone()[0]
+            cursor: Dict[str, str] = dict(self.cursor.fetchall())
+            started_at: Optional[str] = cursor.get("poll_cycle_started_at")
+            finished_at: Optional[str] = cursor.get("poll_cycle_finished_at")
+
+            return (
+                float(started_at) if started_at else None,
+                float(finished_at) if finished_at else None,
+            )
+
+        return self.process(logic)
+
+    def start_poll_cycle(self, started_at: float) -> None:
+        def logic() -> None:
+            self.cursor.execute("DELETE FROM meta WHERE key = 'poll_cycle_finished_at'")
+            self.cursor.execute(
+                "INSERT INTO meta (key, value) VALUES ('poll_cycle_started_at', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (str(started_at),),
+            )
+
+        self.process(logic)
 
-        return self.process(logic)
\ No newline at end of file
+    def finish_poll_cycle(self, finished_at: float) -> None:
+        self.set_meta("poll_cycle_finished_at", str(finished_at))
@@ -1,15 +1,205 @@
-from typing import *
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
 
+import json
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 
+from requests import Response
+from requests.exceptions import ConnectionError, RequestException, Timeout
 from spotipy import Spotify, SpotifyException
-from spotipy.oauth2 import SpotifyOAuth
+from spotipy.oauth2 import SpotifyOAuth, SpotifyOauthError
 
 import random
 
+from api.helpers.cache import TTLCache
+from api.helpers.circuit_breaker import CircuitBreaker
+from api.helpers.http_cache import ValidatorCache
+from api.helpers.quota import QuotaScheduler
+from api.helpers.tracing import tracer
+from api.models.catalog import Catalog
+from api.models.spotify_models import ArtistRef, PlaylistSummary, TrackRef
+
+
+class SpotifyUnavailableError(Exception):
+    pass
+
+
+class SpotifyAuthRevokedError(Exception):
+    pass
+
+
+def is_outage(exception: SpotifyException) -> bool:
+    # 5xx responses, and 5xx retries that ran out, mean Spotify itself is struggling
+    return exception.http_status >= 500 or "Max Retries" in str(exception.msg)
+
+
+class NotifySpotify(Spotify):
+    # GETs on these paths are revalidated with ETags instead of refetched
+    CONDITIONAL_PATHS: Tuple[str, ...] = ("playlists/",)
+
+    def __init__(
+        self,
+        *args,
+        breaker: Optional[CircuitBreaker] = None,
+        validators: Optional[ValidatorCache] = None,
+        quota: Optional[QuotaScheduler] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.breaker: Optional[CircuitBreaker] = breaker
+        self.quota: Optional[QuotaScheduler] = quota
+        self.validators: Optional[ValidatorCache] = validators
+        # spotipy hides both the request headers and the raw response, so the
+        # validator goes in through _auth_headers and the response comes back via a hook
+        self.conditional = threading.local()
+        self._session.hooks["response"].append(self.__remember_response)
+
+    def __remember_response(self, response: Response, *args, **kwargs) -> None:
+        self.conditional.response = response
+
+    def _auth_headers(self) -> Dict[str, str]:
+        headers: Dict[str, str] = super()._auth_headers()
+
+        etag: Optional[str] = getattr(self.conditional, "etag", None)
+        if etag:
+            headers["If-None-Match"] = etag
+
+        return headers
+
+    def __validator_key(self, method: str, path: str, params: Dict[str, any]) -> Optional[str]:
+        if self.validators is None or method != "GET" or not path.startswith(self.CONDITIONAL_PATHS):
+            return None
+
+        return f"{path}?{urlencode(sorted((key, val) for key, val in params.items() if val is not None))}"
+
+    # every Web API request goes through _internal_call, so this is where it gets traced and guarded
+    def _internal_call(self, method, url, payload, params):
+        path: str = url.replace(self.prefix, "").split("?")[0]
+
+        if self.breaker is not None and not self.breaker.allow_request():
+            raise SpotifyUnavailableError(f"Spotify circuit is open, skipped {method} {path}")
+
+        if self.quota is not None:
+            with tracer.span("spotify.quota_wait", lane=self.quota.lane):
+                self.quota.acquire()
+
+        key: Optional[str] = self.__validator_key(method, path, params)
+        cached: Optional[Tuple[str, str]] = self.validators.get(key) if key else None
+
+        # every path records an outcome, a half-open breaker only frees its trial slot that way
+        healthy: bool = False
+
+        with tracer.span(f"spotify.{method}", path=path) as span:
+            self.conditional.etag = cached[0] if cached else None
+            self.conditional.response = None
+
+            try:
+                result = super()._internal_call(method, url, payload, params)
+                healthy = True
+            except SpotifyException as e:
+                if is_outage(e):
+                    raise SpotifyUnavailableError(str(e)) from e
+                # 4xx answers still come from a healthy upstream
+                healthy = True
+                raise
+            except (ConnectionError, Timeout) as e:
+                raise SpotifyUnavailableError(str(e)) from e
+            finally:
+                self.conditional.etag = None
+                if self.breaker is not None:
+                    if healthy:
+                        self.breaker.record_success()
+                    else:
+                        self.breaker.record_failure()
+
+            if key:
+                response: Optional[Response] = self.conditional.response
+
+                if response is not None and response.status_code == 304 and cached:
+                    # unchanged since the last check, the stored body is still current
+                    self.validators.touch(key)
+                    result = json.loads(cached[1])
+                    if span is not None:
+                        span.attrs["revalidated"] = True
+                elif response is not None and result is not None and response.headers.get("ETag"):
+                    self.validators.set(key, response.headers["ETag"], json.dumps(result))
+
+        return result
+
+
+class ListeningProfile:
+    __slots__ = (
+        "catalog",
+        "short_term_track_ids",
+        "short_term_artist_ids",
+        "long_term_track_ids",
+        "long_term_artist_ids",
+        "genres",
+    )
+
+    def __init__(
+        self,
+        catalog: Catalog,
+        short_term_tracks: List[TrackRef],
+        short_term_artists: List[ArtistRef],
+        long_term_tracks: List[TrackRef],
+        long_term_artists: List[ArtistRef],
+    ) -> None:
+        # each user only keeps IDs, the records live once in the shared catalog
+        self.catalog: Catalog = catalog
+        self.short_term_track_ids: Tuple[str, ...] = catalog.add_tracks(short_term_tracks)
+        self.short_term_artist_ids: Tuple[str, ...] = catalog.add_artists(short_term_artists)
+        self.long_term_track_ids: Tuple[str, ...] = catalog.add_tracks(long_term_tracks)
+        self.long_term_artist_ids: Tuple[str, ...] = catalog.add_artists(long_term_artists)
+        # ordered by artist rank, without duplicates
+        self.genres: List[str] = list(
+            dict.fromkeys(genre for artist in self.short_term_artists for genre in artist.genres)
+        )
+
+    @property
+    def short_term_tracks(self) -> List[TrackRef]:
+        return self.catalog.get(self.short_term_track_ids)
+
+    @property
+    def short_term_artists(self) -> List[ArtistRef]:
+        return self.catalog.get(self.short_term_artist_ids)
+
+    @property
+    def long_term_tracks(self) -> List[TrackRef]:
+        return self.catalog.get(self.long_term_track_ids)
+
+    @property
+    def long_term_artists(self) -> List[ArtistRef]:
+        return self.catalog.get(self.long_term_artist_ids)
+
+    def is_complete(self) -> bool:
+        # once the catalog evicted some of its records the profile has to be fetched again
+        return all(
+            self.catalog.contains_all(ids)
+            for ids in (
+                self.short_term_track_ids,
+                self.short_term_artist_ids,
+                self.long_term_track_ids,
+                self.long_term_artist_ids,
+            )
+        )
+
+
 class SpotifyHandler:
     def __init__(
-        self, client_id: str, client_secret: str, redirect_uri: str, scope: str
+        self,
+        client_id: str,
+        client_secret: str,
+        redirect_uri: str,
+        scope: str,
+        profile_ttl: float = 3600,
+        library_ttl: float = 600,
+        breaker: Optional[CircuitBreaker] = None,
+        validators: Optional[ValidatorCache] = None,
+        catalog: Optional[Catalog] = None,
+        quota: Optional[QuotaScheduler] = None,
     ) -> None:
         self.client_id: str = client_id
         self.client_secret: str = client_secret
@@ -21,14 +211,73 @@ class SpotifyHandler:
             redirect_uri=self.redirect_uri,
             scope=self.scope,
         )
-        self.sp: Spotify = Spotify(oauth_manager=self.sp_oauth)
-        self.user_sp: Optional[Spotify] = None
-        self.access_token: Optional[str] = None
-        self.refresh_token: Optional[str] = None
+        self.sp_oauth._session.hooks["response"].append(self.__remember_token_response)
+        self.breaker: CircuitBreaker = breaker or CircuitBreaker()
+        self.validators: Optional[ValidatorCache] = validators
+        # interactive commands, warm-ups and the poller share one Spotify app quota
+        self.quota: QuotaScheduler = quota or QuotaScheduler()
+        self.sp: Spotify = NotifySpotify(
+            oauth_manager=self.sp_oauth, breaker=self.breaker, validators=self.validators, quota=self.quota
+        )
+        # the bot and the poller act on behalf of different users at the same time
+        self.local = threading.local()
+        self.catalog: Catalog = catalog or Catalog()
+        self.profiles: TTLCache = TTLCache(ttl=profile_ttl)
+        self.playlist_libraries: TTLCache = TTLCache(ttl=library_ttl)
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="spotify"
+        )
 
     def __do_nothing(self) -> None:
         pass
 
+    def __remember_token_response(self, response: Response, *args, **kwargs) -> None:
+        self.local.token_status = response.status_code
+
+    @property
+    def user_sp(self) -> Optional[Spotify]:
+        return getattr(self.local, "user_sp", None)
+
+    @user_sp.setter
+    def user_sp(self, user_sp: Optional[Spotify]) -> None:
+        self.local.user_sp = user_sp
+
+    @property
+    def access_token(self) -> Optional[str]:
+        return getattr(self.local, "access_token", None)
+
+    @access_token.setter
+    def access_token(self, access_token: Optional[str]) -> None:
+        self.local.access_token = access_token
+
+    @property
+    def refresh_token(self) -> Optional[str]:
+        return getattr(self.local, "refresh_token", None)
+
+    @refresh_token.setter
+    def refresh_token(self, refresh_token: Optional[str]) -> None:
+        self.local.refresh_token = refresh_token
+
+    @property
+    def token_expires_at(self) -> Optional[float]:
+        return getattr(self.local, "token_expires_at", None)
+
+    @token_expires_at.setter
+    def token_expires_at(self, token_expires_at: Optional[float]) -> None:
+        self.local.token_expires_at = token_expires_at
+
+    @property
+    def current_user(self) -> Optional[int]:
+        return getattr(self.local, "current_user", None)
+
+    @current_user.setter
+    def current_user(self, current_user: Optional[int]) -> None:
+        self.local.current_user = current_user
+
+    def forget_user(self, user: int) -> None:
+        self.profiles.pop(user)
+        self.playlist_libraries.pop(user)
+
     def handle_exception(self, exception: SpotifyException) -> None:
         if exception.http_status == 403:
             print("403 Forbidden: Access to the resource is denied.")
@@ -37,48 +286,116 @@ class SpotifyHandler:
         else:
             print(f"An error occurred: {exception}")
 
-    def get_user_sp(self, access_token: str) -> Spotify:
+    def get_user_sp(self, access_token: str, user: Optional[int] = None) -> Spotify:
         try:
-            self.user_sp: Spotify = Spotify(auth=access_token)
+            self.current_user = user
+            self.user_sp: Spotify = NotifySpotify(
+                auth=access_token, breaker=self.breaker, validators=self.validators, quota=self.quota
+            )
             return self.user_sp
         except SpotifyException as e:
             self.handle_exception(e)
             return None
 
     def refresh_access_token(self) -> str:
+        if not self.breaker.allow_request():
+            raise SpotifyUnavailableError("Spotify circuit is open, skipped token refresh")
+
+        # every path records an outcome, a half-open breaker only frees its trial slot that way
+        healthy: bool = False
+        self.local.token_status = None
+
         try:
-            self.access_token: str = self.sp_oauth.refresh_access_token(self.refresh_token)["access_token"]
+            with tracer.span("spotify.refresh_token"):
+                token_info: Dict[str, any] = self.sp_oauth.refresh_access_token(self.refresh_token)
+            healthy = True
+            self.access_token: str = token_info["access_token"]
+            self.token_expires_at: Optional[float] = token_info.get("expires_at")
             return self.access_token
+        except RequestException as e:
+            raise SpotifyUnavailableError(str(e)) from e
+        except SpotifyOauthError as e:
+            # spotipy drops the status code, the response hook kept it
+            status: Optional[int] = getattr(self.local, "token_status", None)
+            if status is None or status >= 500:
+                raise SpotifyUnavailableError(str(e)) from e
+            # 4xx answers still come from a healthy upstream
+            healthy = True
+            # the user revoked Notify's access or deleted their Spotify account
+            if e.error == "invalid_grant":
+                raise SpotifyAuthRevokedError(str(e)) from e
+            raise
         except SpotifyException as e:
+            healthy = not is_outage(e)
             self.handle_exception(e)
             return None
+        finally:
+            if healthy:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    def find_playlist(self, playlist_id: str) -> Optional[PlaylistSummary]:
+        # unlike get_playlist, None only means Spotify doesn't know the playlist,
+        # every other error is raised so callers don't mistake it for a deletion
+        try:
+            return PlaylistSummary.from_dict(
+                self.user_sp.playlist(playlist_id, fields=PlaylistSummary.FIELDS)
+            )
+        except SpotifyException as e:
+            if e.http_status == 404:
+                return None
+            raise
 
-    def get_playlist(self, playlist_id: str) -> Dict[str, any]:
+    def get_playlist(self, playlist_id: str) -> Optional[PlaylistSummary]:
         try:
-            return self.user_sp.playlist(playlist_id)
+            # without a fields filter Spotify also sends the first 100 tracks
+            return PlaylistSummary.from_dict(
+                self.user_sp.playlist(playlist_id, fields=PlaylistSummary.FIELDS)
+            )
         except SpotifyException as e:
             self.handle_exception(e)
             return None
 
-    def get_playlists_by_ids(self, playlists_ids: List[str]) -> List[Dict[str, any]]:
-        user_playlists: List[Dict[str, any]] = []
+    def get_playlists_by_ids(self, playlists_ids: List[str]) -> List[PlaylistSummary]:
+        return [
+            playlist
+            for playlist in self.get_playlists_parallel(playlists_ids).values()
+            if playlist
+        ]
 
-        for playlist_id in playlists_ids:
-            playlist = self.get_playlist(playlist_id)
-            if playlist:
-                user_playlists.append(playlist)
+    def get_playlists_parallel(self, playlists_ids: List[str]) -> Dict[str, Optional[PlaylistSummary]]:
+        # pool threads don't see this thread's client, so hand it over explicitly
+        sp: Spotify = self.user_sp
 
-        return user_playlists
+        def fetch(playlist_id: str) -> Optional[PlaylistSummary]:
+            try:
+                return PlaylistSummary.from_dict(sp.playlist(playlist_id, fields=PlaylistSummary.FIELDS))
+            except SpotifyException as e:
+                self.handle_exception(e)
+                return None
+
+        futures = {
+            playlist_id: self.executor.submit(self.quota.bind(tracer.bind(fetch)), playlist_id)
+            for playlist_id in playlists_ids
+        }
 
-    def get_user_playlists(self, offset: int = 0, limit: int = 50) -> List[Dict[str, any]]:
-        user_playlists: List[Dict[str, any]] = []
+        return {playlist_id: future.result() for playlist_id, future in futures.items()}
+
+    def get_user_playlists(self, offset: int = 0, limit: int = 50) -> List[PlaylistSummary]:
+        user_playlists: List[PlaylistSummary] = []
+
+        if self.current_user is not None:
+            library: Optional[List[PlaylistSummary]] = self.playlist_libraries.get(self.current_user)
+            if library is not None:
+                return library[offset : offset + limit]
 
         try:
             response: Dict[str, any] = self.user_sp.current_user_playlists(
                 offset=offset, limit=limit
             )
             fetched_playlists = response["items"]
-            user_playlists += fetched_playlists
+            user_playlists += map(PlaylistSummary.from_dict, fetched_playlists)
 
             while len(fetched_playlists) > 50:
                 offset += len(fetched_playlists)
@@ -86,14 +403,64 @@ class SpotifyHandler:
                     offset=offset
                 )
                 fetched_playlists = response["items"]
-                user_playlists += fetched_playlists
+                user_playlists += map(PlaylistSummary.from_dict, fetched_playlists)
         except SpotifyException as e:
             self.handle_exception(e)
             return None
 
         return user_playlists
-    
-    def get_user_last_played(self) -> Dict[str, any]:
+
+    def iter_user_playlist_pages(self, limit: int = 50, max_pages: Optional[int] = None) -> Iterator[Dict[str, any]]:
+        offset: int = 0
+        pages: int = 0
+
+        while max_pages is None or pages < max_pages:
+            response: Dict[str, any] = self.user_sp.current_user_playlists(
+                offset=offset, limit=limit
+            )
+            pages += 1
+
+            yield response
+
+            if not response["items"] or response.get("next") is None:
+                return
+
+            offset += len(response["items"])
+
+    def stream_user_playlist_library(self, max_pages: Optional[int] = None) -> Iterator[List[PlaylistSummary]]:
+        if self.current_user is not None:
+            library: Optional[List[PlaylistSummary]] = self.playlist_libraries.get(self.current_user)
+            if library is not None:
+                yield library
+                return
+
+        library = []
+        complete: bool = False
+
+        for response in self.iter_user_playlist_pages(max_pages=max_pages):
+            playlists: List[PlaylistSummary] = [
+                PlaylistSummary.from_dict(item) for item in response["items"]
+            ]
+            library += playlists
+            complete = response.get("next") is None
+            yield playlists
+
+        # a library cut short by max_pages would serve wrong picker pages from the cache
+        if complete and self.current_user is not None:
+            self.playlist_libraries.set(self.current_user, library)
+
+    def get_user_playlist_library(self, max_pages: Optional[int] = None) -> Optional[List[PlaylistSummary]]:
+        try:
+            return [
+                playlist
+                for playlists in self.stream_user_playlist_library(max_pages=max_pages)
+                for playlist in playlists
+            ]
+        except SpotifyException as e:
+            self.handle_exception(e)
+            return None
+
+    def get_user_last_played(self) -> Optional[TrackRef]:
         try:
             currently_playing: Dict[str, any] = self.user_sp.current_user_playing_track()
 
@@ -102,56 +469,104 @@ class SpotifyHandler:
                     limit=1
                 )
 
-                return last_played["items"][0]["track"]
+                return self.catalog.add_track(TrackRef.from_dict(last_played["items"][0]["track"]))
             else:
-                return currently_playing["item"]
+                return self.catalog.add_track(TrackRef.from_dict(currently_playing["item"]))
         except SpotifyException as e:
             self.handle_exception(e)
             return None
         
-    def get_user_top_tracks(self, time_range: str = "short_term", offset: int = 0, limit: int = 10) -> List[Dict[str, any]]:
+    def get_user_top_tracks(self, time_range: str = "short_term", offset: int = 0, limit: int = 10) -> List[TrackRef]:
         try:
-            top_tracks: List[Dict[str, any]] = self.user_sp.current_user_top_tracks(
+            response: Dict[str, any] = self.user_sp.current_user_top_tracks(
                 offset=offset,
                 limit=limit,
                 time_range=time_range
-            )["items"]
+            )
 
         except SpotifyException as e:
             self.handle_exception(e)
             return None
 
-        return top_tracks
+        return [self.catalog.add_track(TrackRef.from_dict(track)) for track in response["items"]]
         
-    def get_user_top_artists(self, time_range: str = "short_term", offset: int = 0, limit: int = 10) -> List[Dict[str, any]]:
+    def get_user_top_artists(self, time_range: str = "short_term", offset: int = 0, limit: int = 10) -> List[ArtistRef]:
         try:
-            top_artists: List[Dict[str, any]] = self.user_sp.current_user_top_artists(
+            response: Dict[str, any] = self.user_sp.current_user_top_artists(
                 offset=offset,
                 limit=limit,
                 time_range=time_range
-            )["items"]
+            )
 
         except SpotifyException as e:
             self.handle_exception(e)
             return None
 
-        return top_artists
+        return [self.catalog.add_artist(ArtistRef.from_dict(artist)) for artist in response["items"]]
         
-    def get_user_top_genres(self, time_range: str = "short_term", offset: int = 0, limit: int = 10) -> Set[str]:
-        top_genres: Set[str] = set()
-    
-        for artist in self.get_user_top_artists(time_range=time_range, offset=offset, limit=limit):
-            for genre in artist["genres"]:
-                if len(top_genres) >= limit:
-                    return top_genres
-                top_genres.add(genre)
-
-        return top_genres
-    
+    def get_listening_profile(self) -> Optional[ListeningProfile]:
+        user: Optional[int] = self.current_user
+
+        if user is not None:
+            profile: Optional[ListeningProfile] = self.profiles.get(user)
+            if profile is not None and profile.is_complete():
+                return profile
+
+        # pool threads don't see this thread's client, so hand it over explicitly
+        sp: Spotify = self.user_sp
+
+        # parsed in the pool so only the models, not the raw pages, outlive the request
+        def fetch(kind: str, time_range: str) -> Union[List[TrackRef], List[ArtistRef]]:
+            if kind == "tracks":
+                items = sp.current_user_top_tracks(limit=50, time_range=time_range)["items"]
+                return [TrackRef.from_dict(track) for track in items]
+            items = sp.current_user_top_artists(limit=50, time_range=time_range)["items"]
+            return [ArtistRef.from_dict(artist) for artist in items]
+
+        try:
+            with tracer.span("spotify.listening_profile"):
+                futures = [
+                    self.executor.submit(self.quota.bind(tracer.bind(fetch)), kind, time_range)
+                    for time_range in ("short_term", "long_term")
+                    for kind in ("tracks", "artists")
+                ]
+                short_term_tracks, short_term_artists, long_term_tracks, long_term_artists = [
+                    future.result() for future in futures
+                ]
+        except SpotifyException as e:
+            self.handle_exception(e)
+            return None
+
+        profile = ListeningProfile(
+            self.catalog,
+            short_term_tracks=short_term_tracks,
+            short_term_artists=short_term_artists,
+            long_term_tracks=long_term_tracks,
+            long_term_artists=long_term_artists,
+        )
+
+        if user is not None:
+            self.profiles.set(user, profile)
+
+        return profile
+
+    def get_user_top_genres(self, limit: int = 10) -> Set[str]:
+        profile: Optional[ListeningProfile] = self.get_listening_profile()
+
+        if profile is None:
+            return set()
+
+        return set(profile.genres[:limit])
+
     def get_user_recommended_tracks(self, limit: int = 10):
-        seed_tracks: List[str] = [track["id"] for track in self.get_user_top_tracks(limit=1)]
-        seed_artists: List[str] = [artist["id"] for artist in self.get_user_top_artists(limit=1)]
-        seed_genres: Set[str] = self.get_user_top_genres(limit=1)
+        profile: Optional[ListeningProfile] = self.get_listening_profile()
+
+        if profile is None:
+            return None
+
+        seed_tracks: List[str] = [track.id for track in profile.short_term_tracks[:1]]
+        seed_artists: List[str] = [artist.id for artist in profile.short_term_artists[:1]]
+        seed_genres: List[str] = profile.genres[:1]
 
         try:
             print(self.user_sp.recommendations(seed_tracks=seed_tracks, seed_artists=seed_artists, seed_genres=seed_genres, limit=limit))
@@ -163,7 +578,14 @@ class SpotifyHandler:
 
         return recommended_tracks
         
-    def get_user_throwback(self) -> List[Dict[str, any]]:
-        throwback_track: Dict[str, any] = self.get_user_top_tracks(time_range="long_term", offset=0, limit=50)[random.randint(0, 49)]
+    def get_user_throwback(self) -> Optional[TrackRef]:
+        profile: Optional[ListeningProfile] = self.get_listening_profile()
+
+        long_term_tracks: List[TrackRef] = profile.long_term_tracks if profile is not None else []
+
+        if not long_term_tracks:
+            return None
+
+        throwback_track: TrackRef = random.choice(long_term_tracks)
 
-        return throwback_track
\ No newline at end of file
+        return throwback_track
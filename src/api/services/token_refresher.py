@@ -0,0 +1,87 @@
+import random
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from api.helpers.tracing import tracer
+from api.services.database_service import DatabaseHandler
+from api.services.spotify_service import SpotifyAuthRevokedError, SpotifyHandler, SpotifyUnavailableError
+
+
+class TokenRefresher:
+    def __init__(
+        self,
+        spotify: SpotifyHandler,
+        database: DatabaseHandler,
+        window: float = 600,
+        interval: float = 60,
+        batch_size: int = 50,
+        workers: int = 4,
+        is_quiet: Optional[Callable[[], bool]] = None,
+    ) -> None:
+        self.spotify: SpotifyHandler = spotify
+        self.database: DatabaseHandler = database
+        # tokens expiring within this many seconds are refreshed ahead of time
+        self.window: float = window
+        self.interval: float = interval
+        self.batch_size: int = batch_size
+        self.is_quiet: Callable[[], bool] = is_quiet or (lambda: True)
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="token-refresh"
+        )
+
+    def run(self, stop_event: threading.Event) -> None:
+        # jittered rounds of at most batch_size users keep the refreshes spread out
+        while not stop_event.wait(self.interval * random.uniform(0.5, 1.5)):
+            # a busy bot keeps its quota for commands, the window leaves room for a few skipped rounds
+            if not self.is_quiet():
+                continue
+
+            try:
+                self.refresh_expiring()
+            except Exception as e:
+                print(f"Error refreshing access tokens: {e}")
+
+    def refresh_expiring(self) -> int:
+        users: List[Tuple[int, str]] = self.database.fetch_expiring_tokens(
+            time.time() + self.window, self.batch_size
+        )
+
+        if not users:
+            return 0
+
+        with tracer.trace("token_refresh", users=len(users)):
+            results = list(self.executor.map(tracer.bind(self.refresh), users))
+
+        refreshed: List[Tuple[int, str, Optional[float]]] = [result for result in results if result]
+
+        with self.database.batch() as batch:
+            for user, access_token, expires_at in refreshed:
+                batch.store_access_token(access_token, user, expires_at)
+
+        return len(refreshed)
+
+    def refresh(self, user_tokens: Tuple[int, str]) -> Optional[Tuple[int, str, Optional[float]]]:
+        user, refresh_token = user_tokens
+
+        try:
+            self.spotify.refresh_token = refresh_token
+            access_token: Optional[str] = self.spotify.refresh_access_token()
+        except SpotifyAuthRevokedError as e:
+            print(f"Spotify access revoked for user {user}, pausing their alerts: {e}")
+            self.database.deactivate_user(user, "revoked")
+            return None
+        except SpotifyUnavailableError as e:
+            # the token is still valid for a while, the next round tries again
+            print(f"Spotify unavailable, skipped token refresh for user {user}: {e}")
+            return None
+        except Exception as e:
+            print(f"Error refreshing the access token of user {user}: {e}")
+            return None
+
+        if access_token is None:
+            return None
+
+        return user, access_token, self.spotify.token_expires_at
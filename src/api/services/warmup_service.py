@@ -0,0 +1,71 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from api.helpers.quota import QuotaScheduler
+from api.helpers.tracing import tracer
+from api.services.database_service import DatabaseHandler
+from api.services.spotify_service import SpotifyHandler
+
+
+class WarmupService:
+    # spotify requests spent by each part of a warm-up
+    PROFILE_COST: int = 4
+
+    def __init__(
+        self,
+        spotify: SpotifyHandler,
+        workers: int = 2,
+        request_budget: int = 8,
+        max_pending: int = 50,
+    ) -> None:
+        self.spotify: SpotifyHandler = spotify
+        self.request_budget: int = request_budget
+        self.max_pending: int = max_pending
+        self.pending: int = 0
+        self.lock = threading.Lock()
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="warmup"
+        )
+
+    def schedule(self, user: int, access_token: str) -> bool:
+        with self.lock:
+            # a wave of signups just starts cold instead of queueing up quota
+            if self.pending >= self.max_pending:
+                print(f"Skipping warm-up for user {user}: too many pending warm-ups")
+                return False
+            self.pending += 1
+
+        self.executor.submit(self.warm_up, user, access_token)
+        return True
+
+    def watch_queue(self, database: DatabaseHandler, stop_event: threading.Event, interval: float = 5) -> None:
+        while not stop_event.wait(interval):
+            try:
+                for user, access_token in database.pop_warmup_requests():
+                    # the login happened in the web process, so the caches here still
+                    # hold whatever account was linked before
+                    self.spotify.forget_user(user)
+                    self.schedule(user, access_token)
+            except Exception as e:
+                print(f"Error reading the warm-up queue: {e}")
+
+    def warm_up(self, user: int, access_token: str) -> None:
+        try:
+            with tracer.trace("warmup", user=user):
+                self.spotify.quota.lane = QuotaScheduler.WARMUP
+                budget: int = self.request_budget
+                self.spotify.user_sp = self.spotify.get_user_sp(access_token, user)
+
+                if budget >= self.PROFILE_COST:
+                    self.spotify.get_listening_profile()
+                    budget -= self.PROFILE_COST
+
+                if budget > 0:
+                    self.spotify.get_user_playlist_library(max_pages=budget)
+
+        except Exception as e:
+            print(f"Error warming up caches for user {user}: {e}")
+
+        finally:
+            with self.lock:
+                self.pending -= 1
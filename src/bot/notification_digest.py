@@ -0,0 +1,43 @@
+import threading
+import time
+from collections.abc import Callable
+from typing import Any, Dict, List
+
+from api.helpers.telegram_utils import chunk_lines
+
+
+class NotificationDigest:
+    def __init__(self, send: Callable[[int, str], Any], window: float = 0) -> None:
+        self.send: Callable[[int, str], Any] = send
+        # 0 means one digest per poll cycle
+        self.window: float = window
+        self.pending: Dict[int, List[str]] = {}
+        self.first_added_at: Dict[int, float] = {}
+        self.lock = threading.Lock()
+
+    def add(self, user: int, line: str) -> None:
+        with self.lock:
+            self.pending.setdefault(user, []).append(line)
+            self.first_added_at.setdefault(user, time.time())
+
+    def flush(self, force: bool = False) -> None:
+        now: float = time.time()
+
+        with self.lock:
+            due: List[int] = [
+                user
+                for user, added_at in self.first_added_at.items()
+                if force or now - added_at >= self.window
+            ]
+            digests: Dict[int, List[str]] = {user: self.pending.pop(user) for user in due}
+            for user in due:
+                del self.first_added_at[user]
+
+        for user, lines in digests.items():
+            header: str = "📬 Here's what changed in the playlists you track:\n"
+
+            for chunk in chunk_lines(lines, header=header):
+                try:
+                    self.send(user, chunk)
+                except Exception as e:
+                    print(f"Error sending digest to user {user}: {e}")
@@ -1,34 +1,89 @@
+import hashlib
 import threading
 import time
 from collections.abc import Callable
-from typing import *
-
-from telebot import TeleBot
-from telebot.types import *
-
-from api.services.database_service import DatabaseHandler
-from api.services.spotify_service import SpotifyHandler
-
-from api.helpers.spotify_utils import extract_spotify_id
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
+
+from spotipy import SpotifyException
+from spotipy.oauth2 import SpotifyOauthError
+from telebot import TeleBot, apihelper
+from telebot.types import (
+    BotCommand,
+    CallbackQuery,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    Message,
+)
+
+from api.models.spotify_models import PlaylistSummary, TrackRef
+from api.services.database_service import BatchWriter, DatabaseHandler
+from api.services.spotify_service import (
+    ListeningProfile,
+    SpotifyAuthRevokedError,
+    SpotifyHandler,
+    SpotifyUnavailableError,
+)
+
+from api.helpers.quota import QuotaScheduler
+from api.helpers.spotify_utils import extract_spotify_ids
+from api.helpers.telegram_utils import chunk_lines
+from api.helpers.tracing import tracer, traced_telegram_sender
+from bot.notification_digest import NotificationDigest
+from bot.update_dispatcher import ChatDispatcher
 
 
 class NotifyTelegramBot(threading.Thread):
+    # cached access tokens closer than this to expiry are refreshed before use
+    TOKEN_MARGIN: float = 60
+    # how long a poll item waits while interactive commands are using the quota
+    POLL_BACKOFF: float = 1
+    # commands that don't talk to Spotify, so they keep working while the account link is broken
+    ACCOUNT_COMMANDS: Set[str] = {"start", "help", "login", "logout", "digest"}
+
     def __init__(
         self,
         bot_token: str,
         database: DatabaseHandler,
         spotify: SpotifyHandler,
+        update_workers: int = 4,
+        update_queue_size: int = 50,
+        poll_interval: float = 1800,
+        digest_window: float = 0,
+        notify_limit: int = 3,
+        bulk_notify_limit: int = 20,
+        max_missed_checks: int = 3,
     ) -> None:
         threading.Thread.__init__(self)
         self.kill_received = False
+        self.stop_event = threading.Event()
+        self.poll_interval: float = poll_interval
+        self.notify_limit: int = notify_limit
+        self.bulk_notify_limit: int = bulk_notify_limit
+        self.max_missed_checks: int = max_missed_checks
+        self.digest: NotificationDigest = NotificationDigest(
+            send=self.send_alert,
+            window=digest_window,
+        )
+        # updates are handled on several threads, each one for a different user
+        self.local = threading.local()
         self.bot_token: str = bot_token
-        self.bot: TeleBot = TeleBot(self.bot_token)
+        apihelper.CUSTOM_REQUEST_SENDER = traced_telegram_sender
+        # updates are only acknowledged and routed on the polling thread, the dispatcher does the work
+        self.bot: TeleBot = TeleBot(self.bot_token, threaded=False)
         self.database: DatabaseHandler = database
         self.spotify: SpotifyHandler = spotify
         self.user_id: Optional[int] = None
         self.chat_id: Optional[int] = None
         self.message: Optional[Message] = None
         self.callback: str = None
+        self.callback_message_id: Optional[int] = None
+        self.dispatcher: ChatDispatcher = ChatDispatcher(workers=update_workers, max_queue=update_queue_size)
+        self.inflight_callbacks: Set[Tuple[int, str]] = set()
+        self.inflight_lock = threading.Lock()
+        self.last_update_at: float = 0.0
         self.bot.register_message_handler(self.handle_message)
         self.bot.register_callback_query_handler(self.handle_callback, func=lambda call: call.data)
         self.commands: Dict[str, Dict[str, Union[Callable[..., Any], str]]] = {
@@ -77,43 +132,186 @@ class NotifyTelegramBot(threading.Thread):
                 "func": self.throwback,
                 "desc": "Get a track you had on repeat a while ago",
             },
+            "digest": {
+                "func": self.toggle_digest,
+                "desc": "Switch between an alert per playlist change and one combined digest",
+            },
         }
         self.command_list: List[BotCommand] = []
         for key, val in self.commands.items():
             self.command_list.append(BotCommand(f"/{key}", val.get("desc", "")))
-        self.bot.set_my_commands(self.command_list)
 
     def __do_nothing(self) -> None:
         pass
 
+    @property
+    def user_id(self) -> Optional[int]:
+        return getattr(self.local, "user_id", None)
+
+    @user_id.setter
+    def user_id(self, user_id: Optional[int]) -> None:
+        self.local.user_id = user_id
+
+    @property
+    def chat_id(self) -> Optional[int]:
+        return getattr(self.local, "chat_id", None)
+
+    @chat_id.setter
+    def chat_id(self, chat_id: Optional[int]) -> None:
+        self.local.chat_id = chat_id
+
+    @property
+    def message(self) -> Optional[Message]:
+        return getattr(self.local, "message", None)
+
+    @message.setter
+    def message(self, message: Optional[Message]) -> None:
+        self.local.message = message
+
+    @property
+    def callback(self) -> Optional[str]:
+        return getattr(self.local, "callback", None)
+
+    @callback.setter
+    def callback(self, callback: Optional[str]) -> None:
+        self.local.callback = callback
+
+    @property
+    def callback_message_id(self) -> Optional[int]:
+        return getattr(self.local, "callback_message_id", None)
+
+    @callback_message_id.setter
+    def callback_message_id(self, callback_message_id: Optional[int]) -> None:
+        self.local.callback_message_id = callback_message_id
+
+    def reply(self, text: str, **kwargs: Any) -> None:
+        # results of a picker tap replace the picker itself
+        if self.callback_message_id is not None:
+            self.bot.edit_message_text(
+                text,
+                chat_id=self.chat_id,
+                message_id=self.callback_message_id,
+                **kwargs,
+            )
+        else:
+            self.bot.send_message(self.chat_id, text, **kwargs)
+
+    def authenticate_user(self, user: int, batch: Optional[BatchWriter] = None) -> None:
+        access_token, refresh_token, expires_at = self.database.get_tokens(user)
+        self.spotify.refresh_token = refresh_token
+
+        # tokens are normally refreshed ahead of time in the background
+        if access_token and expires_at and expires_at - time.time() > self.TOKEN_MARGIN:
+            self.spotify.access_token = access_token
+        else:
+            self.spotify.access_token = self.spotify.refresh_access_token()
+            if batch is not None:
+                batch.store_access_token(self.spotify.access_token, user, self.spotify.token_expires_at)
+            else:
+                self.database.store_access_token(self.spotify.access_token, user, self.spotify.token_expires_at)
+
+        self.spotify.user_sp = self.spotify.get_user_sp(
+            self.spotify.access_token, user
+        )
+
+    def is_quiet(self, quiet_seconds: float = 5) -> bool:
+        return time.monotonic() - self.last_update_at >= quiet_seconds and not self.dispatcher.pending()
+
     def handle_message(self, message: Message) -> None:
-        self.message: Message = message
-        self.user_id: int = self.message.from_user.id
-        self.chat_id: int = self.message.chat.id
+        self.last_update_at = time.monotonic()
 
-        self.bot.send_chat_action(self.chat_id, "typing")
+        if not self.dispatcher.submit(message.chat.id, self.process_message, message):
+            print(f"Dropped a message from chat {message.chat.id}: its lane is full")
+            # an error escaping the polling thread would drop the rest of the update batch
+            try:
+                self.bot.send_message(message.chat.id, "I'm a bit overwhelmed right now 😵... Please try again in a moment.")
+            except Exception as e:
+                print(f"Error telling chat {message.chat.id} its message was dropped: {e}")
 
-        if message.content_type == "text" and message.text.strip().startswith("/"):
-            self.determine_function()
+    def process_message(self, message: Message) -> None:
+        with tracer.trace("update.message", user=message.from_user.id):
+            self.message: Message = message
+            self.user_id: int = self.message.from_user.id
+            self.chat_id: int = self.message.chat.id
+            self.callback_message_id = None
 
-        else:
-            self.bot.send_message(self.chat_id, "Sorry, I only speak commands...")
+            self.bot.send_chat_action(self.chat_id, "typing")
+
+            if message.content_type == "text" and message.text.strip().startswith("/"):
+                self.determine_function()
+
+            else:
+                self.bot.send_message(self.chat_id, "Sorry, I only speak commands...")
 
     def handle_callback(self, call: CallbackQuery) -> None:
+        self.last_update_at = time.monotonic()
+
+        with tracer.trace("update.callback", user=call.from_user.id, data=call.data):
+            # stop the client's spinner right away, the real work happens on the chat's lane
+            try:
+                self.bot.answer_callback_query(call.id)
+            except Exception as e:
+                # stale queries after a restart can't be answered anymore, but the tap still counts,
+                # and an error escaping the polling thread would drop the rest of the update batch
+                print(f"Error answering callback {call.data}: {e}")
+
+            key: Tuple[int, str] = (call.from_user.id, call.data)
+
+            with self.inflight_lock:
+                if key in self.inflight_callbacks:
+                    return
+                self.inflight_callbacks.add(key)
+
+            chat_id: int = call.message.chat.id if call.message else call.from_user.id
+            if not self.dispatcher.submit(chat_id, self.run_callback, call, key):
+                print(f"Dropped callback {call.data} from chat {chat_id}: its lane is full")
+                with self.inflight_lock:
+                    self.inflight_callbacks.discard(key)
+
+    def run_callback(self, call: CallbackQuery, key: Tuple[int, str]) -> None:
+        try:
+            with tracer.trace("callback.work", user=call.from_user.id, data=call.data):
+                self.process_callback(call)
+        except SpotifyUnavailableError as e:
+            print(f"Spotify unavailable while handling callback {call.data}: {e}")
+            self.spotify_unavailable_message()
+        except SpotifyAuthRevokedError as e:
+            print(f"Spotify access revoked while handling callback {call.data}: {e}")
+            self.database.deactivate_user(self.user_id, "revoked")
+            self.spotify_revoked_message()
+        except Exception as e:
+            print(f"Error handling callback {call.data}: {e}")
+        finally:
+            with self.inflight_lock:
+                self.inflight_callbacks.discard(key)
+
+    def process_callback(self, call: CallbackQuery) -> None:
         self.callback = call.data
-        self.chat_id = call.message.chat.id
         self.user_id = call.from_user.id
+        # Telegram leaves the message out when it's too old or inline, so answer the user directly
+        self.chat_id = call.message.chat.id if call.message else self.user_id
+        self.callback_message_id = call.message.message_id if call.message else None
+
+        if not self.database.user_exists(self.user_id):
+            self.auth_user()
+            return
+
+        self.authenticate_user(self.user_id)
 
         parts = self.callback.split(":")
         action = parts[0]
         
         if len(parts) >= 3 and parts[1] in ("next", "back"):
+            if self.callback_message_id is None:
+                # there's no picker left to page through
+                return
+
             try:
                 offset = int(parts[2])
                 markup = self.gen_playlist_markup(action, offset=offset)
                 self.bot.edit_message_reply_markup(
                     chat_id=self.chat_id,
-                    message_id=call.message.message_id,
+                    message_id=self.callback_message_id,
                     reply_markup=markup
                 )
             except (IndexError, ValueError) as e:
@@ -130,6 +328,7 @@ class NotifyTelegramBot(threading.Thread):
             print(f"Unknown or malformed action: {self.callback}")
 
 
+    @tracer.traced("determine_function")
     def determine_function(self) -> None:
         command: str = self.message.text
         command_exists: bool = False
@@ -138,23 +337,33 @@ class NotifyTelegramBot(threading.Thread):
             if command.startswith(command_item.command):
                 command_exists = True
 
-                if self.database.user_exists(self.user_id):
-                    self.spotify.refresh_token = self.database.get_refresh_token(
-                        self.user_id
-                    )
-                    self.spotify.access_token = self.spotify.refresh_access_token()
-                    self.database.store_access_token(
-                        self.spotify.access_token, self.user_id
-                    )
-                    self.spotify.user_sp = self.spotify.get_user_sp(
-                        self.spotify.access_token
-                    )
-                    command_func: function = self.commands[
-                        command_item.command.strip("/")
-                    ]["func"]
-                    
+                user_state: Optional[Tuple[bool, Optional[str]]] = self.database.get_user_state(self.user_id)
+
+                if user_state is not None:
+                    active, inactive_reason = user_state
+                    # writing to the bot again undoes a block that paused the user's alerts
+                    if not active and inactive_reason == "blocked":
+                        self.database.reactivate_user(self.user_id)
+
+                    command_name: str = command_item.command.strip("/")
+                    command_func: function = self.commands[command_name]["func"]
+
+                    # the stored token may still work for a while, but the user has to log in again
+                    if command_name not in self.ACCOUNT_COMMANDS and not active and inactive_reason == "revoked":
+                        self.spotify_revoked_message()
+                        continue
+
                     try:
+                        if command_name not in self.ACCOUNT_COMMANDS:
+                            self.authenticate_user(self.user_id)
                         command_func()
+                    except SpotifyUnavailableError as e:
+                        print(f"Spotify unavailable while executing command {command}: {e}")
+                        self.spotify_unavailable_message()
+                    except SpotifyAuthRevokedError as e:
+                        print(f"Spotify access revoked while executing command {command}: {e}")
+                        self.database.deactivate_user(self.user_id, "revoked")
+                        self.spotify_revoked_message()
                     except Exception as e:
                         print(f"Error executing command {command}: {e}")
                         self.bot.send_message(
@@ -173,7 +382,10 @@ class NotifyTelegramBot(threading.Thread):
             )
 
     def auth_user(self) -> None:
-        if self.database.user_exists(self.user_id):
+        user_state: Optional[Tuple[bool, Optional[str]]] = self.database.get_user_state(self.user_id)
+
+        # a revoked user is still registered, but needs to go through the authorization again
+        if user_state is not None and user_state != (False, "revoked"):
             self.bot.send_message(self.chat_id, "You're already logged in.")
         else:
             auth_url: Any = self.spotify.sp_oauth.get_authorize_url(state=self.user_id)
@@ -186,6 +398,7 @@ class NotifyTelegramBot(threading.Thread):
     def delete_user(self) -> None:
         if self.database.user_exists(self.user_id):
             self.database.delete_user(self.user_id)
+            self.spotify.forget_user(self.user_id)
             self.bot.send_message(
                 self.chat_id,
                 "Your data has been deleted from Notify. Sorry to see you go!",
@@ -205,6 +418,19 @@ class NotifyTelegramBot(threading.Thread):
             "This command is temporarily disabled... Try it again later!",
         )
 
+    def spotify_unavailable_message(self) -> None:
+        self.reply(
+            "Spotify isn't responding right now 😕... Give it a few minutes and try again!",
+        )
+
+    def spotify_revoked_message(self) -> None:
+        auth_url: Any = self.spotify.sp_oauth.get_authorize_url(state=self.user_id)
+        self.bot.send_message(
+            self.chat_id,
+            f"I can't access your Spotify account anymore 😕... Please <a href='{auth_url}'>authorize me</a> again.",
+            parse_mode="HTML",
+        )
+
     def deprecated_message(self) -> None:
         self.bot.send_message(
             self.chat_id,
@@ -223,14 +449,19 @@ class NotifyTelegramBot(threading.Thread):
         )
 
     def last_played(self) -> None:
-        last_played: Dict[str, any] = self.spotify.get_user_last_played()
+        last_played: Optional[TrackRef] = self.spotify.get_user_last_played()
+
+        if not last_played:
+            self.bot.send_message(
+                self.chat_id,
+                "I couldn't find the last track you played.",
+            )
+            return
 
-        track_name: str = last_played["name"]
-        track_url: str = last_played["external_urls"]["spotify"]
-        artist_name: str = last_played["artists"][0]["name"]
-        artist_url: str = last_played["artists"][0][
-            "external_urls"
-        ]["spotify"]
+        track_name: str = last_played.name
+        track_url: str = last_played.url
+        artist_name: str = last_played.artist.name
+        artist_url: str = last_played.artist.url
 
         self.bot.send_message(
             self.chat_id,
@@ -239,31 +470,55 @@ class NotifyTelegramBot(threading.Thread):
         )
 
     def retrieve_playlists(self) -> None:
-        playlists = self.spotify.get_user_playlists()
+        header: str = "Here's a list of the playlists in your library:\n"
+        playlist_lines: List[str] = []
+        sent_messages: List[Tuple[Message, str]] = []
+
+        # each page goes out as soon as it arrives: the last message is edited
+        # until it's full, then the next chunk starts a new message
+        for playlists in self.spotify.stream_user_playlist_library():
+            playlist_lines += [
+                f"<a href='{playlist.url}'>{playlist.name}</a>"
+                for playlist in playlists
+            ]
+
+            for i, chunk in enumerate(chunk_lines(playlist_lines, header=header)):
+                if i < len(sent_messages):
+                    message, text = sent_messages[i]
+                    if text != chunk:
+                        self.bot.edit_message_text(
+                            chunk,
+                            chat_id=self.chat_id,
+                            message_id=message.message_id,
+                            parse_mode="HTML",
+                        )
+                        sent_messages[i] = (message, chunk)
+                else:
+                    message = self.bot.send_message(
+                        self.chat_id,
+                        chunk,
+                        parse_mode="HTML",
+                    )
+                    sent_messages.append((message, chunk))
 
-        playlist_names: List[str] = [playlist["name"] for playlist in playlists]
-        playlist_urls: List[str] = [
-            playlist["external_urls"]["spotify"] for playlist in playlists
-        ]
-        playlists_message: str = ""
+        if not sent_messages:
+            self.bot.send_message(self.chat_id, header)
 
-        for name, url in zip(playlist_names, playlist_urls):
-            playlists_message += f"\n<a href='{url}'>{name}</a>"
+    def top_ten(self) -> None:
+        profile: Optional[ListeningProfile] = self.spotify.get_listening_profile()
 
-        self.bot.send_message(
-            self.chat_id,
-            f"Here's a list of the playlists in your library:\n{playlists_message}",
-            parse_mode="HTML",
-        )
+        if not profile or not profile.short_term_tracks:
+            self.bot.send_message(
+                self.chat_id,
+                "I couldn't find any tracks you've been listening to lately.",
+            )
+            return
 
-    def top_ten(self) -> None:
-        top_ten: Dict[str, any] = self.spotify.get_user_top_tracks(limit=10)
+        top_ten: List[TrackRef] = profile.short_term_tracks[:10]
 
-        top_ten_names: List[str] = [track["name"] for track in top_ten]
-        top_ten_urls: List[str] = [
-            track["external_urls"]["spotify"] for track in top_ten
-        ]
-        top_ten_artists: List[str] = [track["artists"][0]["name"] for track in top_ten]
+        top_ten_names: List[str] = [track.name for track in top_ten]
+        top_ten_urls: List[str] = [track.url for track in top_ten]
+        top_ten_artists: List[str] = [track.artist.name for track in top_ten]
         top_ten_message: str = ""
 
         for i, (track_name, track_url, artist_name) in enumerate(
@@ -282,15 +537,13 @@ class NotifyTelegramBot(threading.Thread):
     def recommended(self) -> None:
         recommended_tracks = self.spotify.get_user_recommended_tracks()
 
-        recommended_names: List[str] = [track["name"] for track in recommended_tracks]
-        recommended_urls: List[str] = [
-            track["external_urls"]["spotify"] for track in recommended_tracks
-        ]
+        recommended_names: List[str] = [track.name for track in recommended_tracks]
+        recommended_urls: List[str] = [track.url for track in recommended_tracks]
         recommended_artists: List[str] = [
-            track["artists"][0]["name"] for track in recommended_tracks
+            track.artist.name for track in recommended_tracks
         ]
         recommended_artists_urls: List[str] = [
-            track["artists"][0]["external_urls"]["spotify"] for track in recommended_tracks
+            track.artist.url for track in recommended_tracks
         ]
         recommended_message: str = ""
 
@@ -311,14 +564,19 @@ class NotifyTelegramBot(threading.Thread):
         )
 
     def throwback(self) -> None:
-        throwback: Dict[str, any] = self.spotify.get_user_throwback()
+        throwback: Optional[TrackRef] = self.spotify.get_user_throwback()
+
+        if not throwback:
+            self.bot.send_message(
+                self.chat_id,
+                "I couldn't find a throwback for you yet. Keep listening!",
+            )
+            return
 
-        track_name: str = throwback["name"]
-        track_url: str = throwback["external_urls"]["spotify"]
-        artist_name: str = throwback["artists"][0]["name"]
-        artist_url: str = throwback["artists"][0][
-            "external_urls"
-        ]["spotify"]
+        track_name: str = throwback.name
+        track_url: str = throwback.url
+        artist_name: str = throwback.artist.name
+        artist_url: str = throwback.artist.url
 
         self.bot.send_message(
             self.chat_id,
@@ -326,6 +584,20 @@ class NotifyTelegramBot(threading.Thread):
             parse_mode="HTML",
         )
 
+    def toggle_digest(self) -> None:
+        if self.database.get_delivery_mode(self.user_id) == "digest":
+            self.database.set_delivery_mode(self.user_id, "immediate")
+            self.bot.send_message(
+                self.chat_id,
+                "You'll now get a separate alert for every playlist change.",
+            )
+        else:
+            self.database.set_delivery_mode(self.user_id, "digest")
+            self.bot.send_message(
+                self.chat_id,
+                "You'll now get one digest with all the changes from each check.",
+            )
+
     def gen_playlist_markup(self, callback_action: str, offset: int = 0, limit: int = 4) -> InlineKeyboardMarkup:
         self.callback: str = callback_action
 
@@ -335,14 +607,14 @@ class NotifyTelegramBot(threading.Thread):
         playlists = self.spotify.get_user_playlists(offset=offset, limit=limit + 1)
         
         theres_more: bool = len(playlists) > limit
-        displayed_playlists: List[Dict[str, any]] = playlists[:limit]
+        displayed_playlists: List[PlaylistSummary] = playlists[:limit]
 
         playlist_buttons: List[InlineKeyboardButton] = []
 
         for playlist in displayed_playlists:
 
-            playlist_name: str = playlist["name"]
-            playlist_id: str = playlist["id"]
+            playlist_name: str = playlist.name
+            playlist_id: str = playlist.id
 
             playlist_buttons.append(
                 InlineKeyboardButton(
@@ -377,15 +649,17 @@ class NotifyTelegramBot(threading.Thread):
         parts = message_text.split(maxsplit=1)
 
         if len(parts) > 1:
-            playlist_id = extract_spotify_id(parts[1].strip())
-            playlist = self.spotify.get_playlist(playlist_id)
-
-            print(playlist)
+            playlists_ids: List[str] = extract_spotify_ids(parts[1])
 
-            self.bot.send_message(
-                self.chat_id,
-                f"Received playlist URL: {playlist_id}",
-            )
+            if not playlists_ids:
+                self.bot.send_message(
+                    self.chat_id,
+                    "I couldn't find any Spotify playlist links in your message.",
+                )
+            elif action == "add":
+                self.add_notify_many(playlists_ids)
+            else:
+                self.remove_notify_many(playlists_ids)
         else:
             markup: InlineKeyboardMarkup = self.gen_playlist_markup(
                 callback_action=f"{action}_playlist"
@@ -397,36 +671,84 @@ class NotifyTelegramBot(threading.Thread):
                 reply_markup=markup,
             )
 
+    def add_notify_many(self, playlists_ids: List[str]) -> None:
+        tracked: Set[str] = set(self.database.get_notify_playlists_by_user(self.user_id))
+        already_tracked: List[str] = [playlist_id for playlist_id in playlists_ids if playlist_id in tracked]
+        candidates: List[str] = [playlist_id for playlist_id in playlists_ids if playlist_id not in tracked][
+            : self.bulk_notify_limit
+        ]
+
+        playlists: Dict[str, Optional[PlaylistSummary]] = self.spotify.get_playlists_parallel(candidates)
+        valid: List[PlaylistSummary] = [playlist for playlist in playlists.values() if playlist]
+        invalid_count: int = len(candidates) - len(valid)
+
+        free_slots: int = max(0, self.notify_limit - len(tracked))
+        added: List[PlaylistSummary] = valid[:free_slots]
+        over_limit: List[PlaylistSummary] = valid[free_slots:]
+
+        if added:
+            self.database.add_notify_many(
+                self.user_id,
+                [(playlist.id, playlist.snapshot_id) for playlist in added],
+            )
+
+        summary: List[str] = []
+        if added:
+            summary.append("Now tracking:")
+            summary += [f"- {playlist.name}" for playlist in added]
+        if already_tracked:
+            summary.append(f"Already tracking {len(already_tracked)} of the playlists you sent.")
+        if invalid_count:
+            summary.append(f"{invalid_count} of the links are not valid playlists or don't exist.")
+        if over_limit:
+            summary.append(
+                f"You can only track up to {self.notify_limit} playlists at a time, so these were skipped:"
+            )
+            summary += [f"- {playlist.name}" for playlist in over_limit]
+        if len(playlists_ids) - len(already_tracked) > len(candidates):
+            summary.append(f"Only the first {self.bulk_notify_limit} new links in a message are checked.")
+
+        self.bot.send_message(self.chat_id, "\n".join(summary))
+
+    def remove_notify_many(self, playlists_ids: List[str]) -> None:
+        tracked: Set[str] = set(self.database.get_notify_playlists_by_user(self.user_id))
+        removed: List[str] = [playlist_id for playlist_id in playlists_ids if playlist_id in tracked]
+
+        if removed:
+            self.database.delete_notify_many(self.user_id, removed)
+
+        summary: List[str] = [f"Stopped tracking {len(removed)} playlist{'s' if len(removed) != 1 else ''}."]
+        if len(removed) < len(playlists_ids):
+            summary.append(f"You weren't tracking {len(playlists_ids) - len(removed)} of the playlists you sent.")
+
+        self.bot.send_message(self.chat_id, "\n".join(summary))
+
     def add_notify(self, playlist_id: str) -> None:
-        playlist: Dict[str, any] = self.spotify.get_playlist(playlist_id)
+        playlist: Optional[PlaylistSummary] = self.spotify.get_playlist(playlist_id)
 
         if playlist:
-            if self.database.playlist_exists(self.user_id, playlist["id"]):
-                self.bot.send_message(
-                    self.chat_id,
+            if self.database.playlist_exists(self.user_id, playlist.id):
+                self.reply(
                     "You're already tracking this playlist.",
                 )
             else:
                 notify_count: int = len(self.database.get_notify_playlists_by_user(self.user_id))
 
-                if notify_count >= 3:
-                    self.bot.send_message(
-                        self.chat_id,
-                        "You can only track up to 3 playlists at a time. Please remove one before adding another.",
+                if notify_count >= self.notify_limit:
+                    self.reply(
+                        f"You can only track up to {self.notify_limit} playlists at a time. Please remove one before adding another.",
                     )
                 else:
                     self.database.add_notify(
                         telegram_user_id=self.user_id,
-                        playlist_id=playlist["id"],
-                        snapshot_id=playlist["snapshot_id"],
+                        playlist_id=playlist.id,
+                        snapshot_id=playlist.snapshot_id,
                     )
-                    self.bot.send_message(
-                        self.chat_id,
-                        f"Now tracking the playlist: {playlist['name']}",
+                    self.reply(
+                        f"Now tracking the playlist: {playlist.name}",
                     )
         else:
-            self.bot.send_message(
-                self.chat_id,
+            self.reply(
                 "The playlist you provided is not valid or does not exist.",
             )
 
@@ -434,26 +756,23 @@ class NotifyTelegramBot(threading.Thread):
         if not telegram_user_id:
             telegram_user_id = self.user_id
 
-        playlist: Dict[str, any] = self.spotify.get_playlist(playlist_id)
+        playlist: Optional[PlaylistSummary] = self.spotify.get_playlist(playlist_id)
 
         if playlist:
-            if self.database.playlist_exists(telegram_user_id, playlist["id"]):
+            if self.database.playlist_exists(telegram_user_id, playlist.id):
                 self.database.delete_notify(
                     telegram_user_id=telegram_user_id,
-                    playlist_id=playlist["id"],
+                    playlist_id=playlist.id,
                 )
-                self.bot.send_message(
-                    self.chat_id,
-                    f"Stopped tracking the playlist: {playlist['name']}",
+                self.reply(
+                    f"Stopped tracking the playlist: {playlist.name}",
                 )
             else:
-                self.bot.send_message(
-                    self.chat_id,
+                self.reply(
                     "You're not tracking this playlist.",
                 )
         else:
-            self.bot.send_message(
-                self.chat_id,
+            self.reply(
                 "The playlist you provided is not valid or does not exist.",
             )
 
@@ -466,7 +785,7 @@ class NotifyTelegramBot(threading.Thread):
                 "You're not tracking any playlists.",
             )
         else:
-            playlists: List[Dict[str, any]] = self.spotify.get_playlists_by_ids(playlists_ids)
+            playlists: List[PlaylistSummary] = self.spotify.get_playlists_by_ids(playlists_ids)
 
             if not playlists:
                 self.bot.send_message(
@@ -477,7 +796,7 @@ class NotifyTelegramBot(threading.Thread):
                 message: str = "You're currently tracking these playlists:\n"
 
                 for playlist in playlists:
-                    message += f"- <a href='{playlist['external_urls']['spotify']}'>{playlist['name']}</a>\n"
+                    message += f"- <a href='{playlist.url}'>{playlist.name}</a>\n"
 
                 self.bot.send_message(
                     self.chat_id,
@@ -486,60 +805,188 @@ class NotifyTelegramBot(threading.Thread):
                 )
 
     def notify_changes(self) -> None:
-        while True:
+        self.spotify.quota.lane = QuotaScheduler.BACKGROUND
+
+        while not self.stop_event.is_set():
+            started_at, finished_at = self.database.get_poll_cursor()
+            now: float = time.time()
+
+            if started_at is not None and finished_at is None:
+                print("Resuming Notify changes check started at: ", time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started_at)))
+            elif finished_at is not None and now - finished_at < self.poll_interval:
+                # a restart shouldn't cost an extra round of checks
+                self.stop_event.wait(self.poll_interval - (now - finished_at))
+                continue
+            else:
+                started_at = now
+                self.database.start_poll_cycle(started_at)
+
             try:
-                users: List[int] = self.database.fetch_telegram_users()
-
-                if users:
-                    for user in users:
-                        notify_playlists_ids: List[str] = self.database.get_notify_playlists_by_user(user)
-
-                        if notify_playlists_ids:
-                            self.spotify.refresh_token = self.database.get_refresh_token(
-                                    user
-                                )
-                            self.spotify.access_token = self.spotify.refresh_access_token()
-                            self.database.store_access_token(
-                                self.spotify.access_token, user
+                if self.run_poll_cycle(started_at):
+                    self.database.finish_poll_cycle(time.time())
+                    print("Ran Notify changes check at: ", time.strftime("%Y-%m-%d %H:%M:%S"))
+            except SpotifyUnavailableError as e:
+                # don't spend the rest of the cycle on a dead upstream, resume once the circuit half-opens
+                retry_after: float = max(self.spotify.breaker.retry_after(), 1)
+                print(f"Spotify unavailable, pausing Notify changes check for {retry_after:.0f}s: {e}")
+                self.stop_event.wait(retry_after)
+            except Exception as e:
+                print(f"Error checking playlists: {e}")
+                # the cursor stays open, so the next attempt picks up where this one stopped
+                self.stop_event.wait(self.poll_interval)
+
+        # don't drop digests that were still waiting for their window
+        self.digest.flush(force=True)
+
+    def run_poll_cycle(self, cycle_started_at: float) -> bool:
+        try:
+            poll_items: List[Tuple[int, str, str, str, int]] = self.database.fetch_poll_items(cycle_started_at)
+
+            if not poll_items:
+                print("No playlists to check in the database.")
+                return True
+
+            with self.database.batch() as batch:
+                for user, user_items in groupby(poll_items, key=itemgetter(0)):
+                    if self.stop_event.is_set():
+                        return False
+
+                    try:
+                        self.authenticate_user(user, batch)
+                    except SpotifyAuthRevokedError as e:
+                        # their playlists can't be read anymore, so stop polling them until they log in again
+                        print(f"Spotify access revoked for user {user}, pausing their alerts: {e}")
+                        self.database.deactivate_user(user, "revoked")
+                        self.spotify.forget_user(user)
+                        batch.after_flush(
+                            partial(
+                                self.send_alert,
+                                user,
+                                "I can't access your Spotify account anymore, so your playlist alerts are paused. Send /login to link it again.",
                             )
-                            self.spotify.user_sp = self.spotify.get_user_sp(
-                                self.spotify.access_token
+                        )
+                        continue
+                    except SpotifyOauthError as e:
+                        # one user's broken tokens shouldn't hold up everyone after them
+                        print(f"Error authenticating user {user}, skipping their playlists: {e}")
+                        continue
+
+                    if self.spotify.access_token is None:
+                        print(f"No access token for user {user}, skipping their playlists")
+                        continue
+
+                    for _, playlist_id, stored_snapshot_id, delivery_mode, missed_checks in user_items:
+                        if self.stop_event.is_set():
+                            return False
+
+                        # users waiting on a command feel a slow quota far more than the poller does
+                        if self.spotify.quota.interactive_busy():
+                            self.stop_event.wait(self.POLL_BACKOFF)
+
+                        with tracer.trace("poll.item", user=user, playlist=playlist_id):
+                            self.check_playlist(
+                                user, playlist_id, stored_snapshot_id, batch, delivery_mode, missed_checks
                             )
 
-                            for playlist_id in notify_playlists_ids:
-                                playlist: Dict[str, any] = self.spotify.get_playlist(playlist_id)
-
-                                if playlist is not None:
-                                    current_snapshot_id: str = playlist["snapshot_id"]
-                                    stored_snapshot_id: str = self.database.get_notify_snapshot(user, playlist_id)
-                                    
-                                    if current_snapshot_id != stored_snapshot_id:
-                                        self.database.update_notify_snapshot(
-                                            telegram_user_id=user,
-                                            playlist_id=playlist_id,
-                                            snapshot_id=current_snapshot_id,
-                                        )
-                                        self.bot.send_message(
-                                            user,
-                                            f"The playlist {playlist['name']} has been updated! Check it out: {playlist['external_urls']['spotify']}",
-                                        )
-                                else:
-                                    self.remove_notify(playlist_id, user)
-                                    self.bot.send_message(
-                                        user,
-                                        f"Some of the playlists you were tracking no longer exists. They will be removed from your tracking list.",
-                                    )
-                else:
-                    print("No users found in the database.")
+            return True
+        finally:
+            # digests that came due go out even when this cycle had nothing to check
+            self.digest.flush()
 
-                print("Ran Notify changes check at: ", time.strftime("%Y-%m-%d %H:%M:%S"))
-            except Exception as e:
-                print(f"Error checking playlists: {e}")
-            time.sleep(1800)  # 30 minutos = 1800 segundos
+    def send_alert(self, user: int, text: str) -> None:
+        try:
+            self.bot.send_message(user, text)
+        except apihelper.ApiTelegramException as e:
+            # the user blocked the bot or deleted their Telegram account
+            if e.error_code == 403:
+                print(f"User {user} can't be reached anymore, pausing their alerts: {e.description}")
+                self.database.deactivate_user(user, "blocked")
+            else:
+                raise
+
+    def deliver(self, user: int, delivery_mode: str, message: str, digest_line: str) -> None:
+        if delivery_mode == "digest":
+            self.digest.add(user, digest_line)
+        else:
+            self.send_alert(user, message)
+
+    def check_playlist(
+        self,
+        user: int,
+        playlist_id: str,
+        stored_snapshot_id: str,
+        batch: BatchWriter,
+        delivery_mode: str = "immediate",
+        missed_checks: int = 0,
+    ) -> None:
+        try:
+            playlist: Optional[PlaylistSummary] = self.spotify.find_playlist(playlist_id)
+        except SpotifyException as e:
+            # errors like rate limits say nothing about the playlist, it's checked again next cycle
+            self.spotify.handle_exception(e)
+            return
+
+        # alerts go out only once the matching snapshot is committed, so a
+        # restarted cycle never alerts twice for the same change
+        if playlist is not None:
+            current_snapshot_id: str = playlist.snapshot_id
+            batch.mark_checked(user, playlist_id, time.time())
+
+            if current_snapshot_id != stored_snapshot_id:
+                batch.update_notify_snapshot(
+                    telegram_user_id=user,
+                    playlist_id=playlist_id,
+                    snapshot_id=current_snapshot_id,
+                )
+                batch.after_flush(
+                    lambda: self.deliver(
+                        user,
+                        delivery_mode,
+                        f"The playlist {playlist.name} has been updated! Check it out: {playlist.url}",
+                        f"- {playlist.name} was updated: {playlist.url}",
+                    )
+                )
+        elif missed_checks + 1 < self.max_missed_checks:
+            # a single 404 can be a hiccup, only one that keeps repeating means the playlist is gone
+            batch.record_miss(user, playlist_id, time.time())
+        else:
+            batch.deactivate_notify(telegram_user_id=user, playlist_id=playlist_id)
+            batch.after_flush(
+                lambda: self.deliver(
+                    user,
+                    delivery_mode,
+                    f"Some of the playlists you were tracking no longer exists. They will be removed from your tracking list.",
+                    f"- A playlist you were tracking no longer exists and was removed from your tracking list.",
+                )
+            )
+
+    def stop(self) -> None:
+        # in-flight poll items finish and the batch flushes the cursor on its way out
+        self.stop_event.set()
+        self.kill_received = True
+        self.dispatcher.stop()
+
+    def register_commands(self) -> None:
+        commands_hash: str = hashlib.sha256(
+            "\n".join(
+                f"{command_item.command}:{command_item.description}"
+                for command_item in self.command_list
+            ).encode()
+        ).hexdigest()
+
+        # the command menu rarely changes, so most restarts skip the round trip
+        if self.database.get_meta("commands_hash") == commands_hash:
+            return
+
+        try:
+            self.bot.set_my_commands(self.command_list)
+            self.database.set_meta("commands_hash", commands_hash)
+        except Exception as e:
+            print(f"Error registering bot commands: {e}")
 
     def start_listening(self) -> None:
         try:
-            self.database.create_tables()
+            threading.Thread(target=self.register_commands, daemon=True).start()
             self.bot.infinity_polling()
 
             print("Notify started!")
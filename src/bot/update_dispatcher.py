@@ -0,0 +1,53 @@
+import queue
+import threading
+from collections.abc import Callable
+from typing import Any, List, Optional, Tuple
+
+
+class ChatDispatcher:
+    def __init__(self, workers: int = 4, max_queue: int = 50) -> None:
+        # a chat always lands on the same lane, so its updates run in order
+        # while different chats are handled in parallel
+        self.lanes: List["queue.Queue[Optional[Tuple[Callable[..., Any], tuple]]]"] = [
+            queue.Queue(maxsize=max_queue) for _ in range(max(1, workers))
+        ]
+        self.threads: List[threading.Thread] = [
+            threading.Thread(target=self.__work, args=(lane,), daemon=True, name=f"chat-lane-{i}")
+            for i, lane in enumerate(self.lanes)
+        ]
+
+        for thread in self.threads:
+            thread.start()
+
+    def pending(self) -> int:
+        return sum(lane.qsize() for lane in self.lanes)
+
+    def submit(self, chat_id: int, func: Callable[..., Any], *args: Any) -> bool:
+        lane: "queue.Queue" = self.lanes[hash(chat_id) % len(self.lanes)]
+
+        try:
+            lane.put_nowait((func, args))
+            return True
+        except queue.Full:
+            # shedding the update beats letting the whole lane fall further behind
+            return False
+
+    def stop(self) -> None:
+        for lane in self.lanes:
+            try:
+                lane.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def __work(self, lane: "queue.Queue") -> None:
+        while True:
+            task: Optional[Tuple[Callable[..., Any], tuple]] = lane.get()
+
+            if task is None:
+                return
+
+            func, args = task
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Error handling update: {e}")
@@ -13,3 +13,40 @@ REDIRECT_URI = os.getenv("REDIRECT_URI")
 SERVER_HOST = os.getenv("SERVER_HOST")
 SERVER_PORT = os.getenv("SERVER_PORT")
 NOTIFY_DB = os.getenv("NOTIFY_DB")
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", "50"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "2000"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "data/profiles")
+LISTENING_PROFILE_TTL = float(os.getenv("LISTENING_PROFILE_TTL", "3600"))
+PLAYLIST_LIBRARY_TTL = float(os.getenv("PLAYLIST_LIBRARY_TTL", "600"))
+WARMUP_WORKERS = int(os.getenv("WARMUP_WORKERS", "2"))
+WARMUP_REQUEST_BUDGET = int(os.getenv("WARMUP_REQUEST_BUDGET", "8"))
+WARMUP_MAX_PENDING = int(os.getenv("WARMUP_MAX_PENDING", "50"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "4"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "50"))
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "false").lower() in ("1", "true", "yes")
+IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "400"))
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "1800"))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "30"))
+SPOTIFY_BREAKER_FAILURE_RATE = float(os.getenv("SPOTIFY_BREAKER_FAILURE_RATE", "0.5"))
+SPOTIFY_BREAKER_MIN_CALLS = int(os.getenv("SPOTIFY_BREAKER_MIN_CALLS", "10"))
+SPOTIFY_BREAKER_WINDOW = int(os.getenv("SPOTIFY_BREAKER_WINDOW", "20"))
+SPOTIFY_BREAKER_OPEN_SECONDS = float(os.getenv("SPOTIFY_BREAKER_OPEN_SECONDS", "60"))
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", "0"))
+ROLES = ("all", "bot", "web", "poller")
+NOTIFY_ROLE = os.getenv("NOTIFY_ROLE", "all")
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "30"))
+HEALTH_MAX_AGE = float(os.getenv("HEALTH_MAX_AGE", "120"))
+LOGIN_WORKERS = int(os.getenv("LOGIN_WORKERS", "4"))
+NOTIFY_LIMIT = int(os.getenv("NOTIFY_LIMIT", "3"))
+BULK_NOTIFY_LIMIT = int(os.getenv("BULK_NOTIFY_LIMIT", "20"))
+HTTP_CACHE_DB = os.getenv("HTTP_CACHE_DB", "data/http_cache.db")
+HTTP_CACHE_MAX_AGE = float(os.getenv("HTTP_CACHE_MAX_AGE", "604800"))
+MAX_MISSED_CHECKS = int(os.getenv("MAX_MISSED_CHECKS", "3"))
+TOKEN_REFRESH_WINDOW = float(os.getenv("TOKEN_REFRESH_WINDOW", "600"))
+TOKEN_REFRESH_INTERVAL = float(os.getenv("TOKEN_REFRESH_INTERVAL", "60"))
+TOKEN_REFRESH_BATCH = int(os.getenv("TOKEN_REFRESH_BATCH", "50"))
+TOKEN_REFRESH_WORKERS = int(os.getenv("TOKEN_REFRESH_WORKERS", "4"))
+CATALOG_MAX_BYTES = int(os.getenv("CATALOG_MAX_BYTES", "16777216"))
+SPOTIFY_QUOTA_RATE = float(os.getenv("SPOTIFY_QUOTA_RATE", "10"))
+SPOTIFY_QUOTA_BURST = int(os.getenv("SPOTIFY_QUOTA_BURST", "20"))
@@ -1,42 +1,107 @@
+import time
+
+STARTED_AT: float = time.perf_counter()
+
+import argparse
 import threading
 import signal
 import sys
-from typing import *
-
-import requests
-from flask import Flask, render_template, request, send_file
-from spotipy import Spotify
-from telebot.types import *
-
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from api.helpers.circuit_breaker import CircuitBreaker
+from api.helpers.health import Heartbeat, heartbeat_is_fresh
+from api.helpers.http_cache import ValidatorCache
+from api.helpers.quota import QuotaScheduler
+from api.helpers.startup import StartupProfile
 from api.services.database_service import DatabaseHandler
-from api.services.spotify_service import SpotifyHandler
-from bot.telegram_bot import NotifyTelegramBot
+from api.helpers.tracing import tracer
+from api.models.catalog import Catalog
 from config.config import (
     BOT_API_TOKEN,
+    BULK_NOTIFY_LIMIT,
+    CATALOG_MAX_BYTES,
+    DB_BUSY_TIMEOUT,
+    DIGEST_WINDOW,
+    HEALTH_MAX_AGE,
+    HTTP_CACHE_DB,
+    HTTP_CACHE_MAX_AGE,
+    IMPORT_TIME_BUDGET_MS,
+    LISTENING_PROFILE_TTL,
+    LOGIN_WORKERS,
+    MAX_MISSED_CHECKS,
+    PLAYLIST_LIBRARY_TTL,
+    POLL_INTERVAL,
+    NOTIFY_BATCH_SIZE,
     NOTIFY_DB,
+    NOTIFY_LIMIT,
+    NOTIFY_ROLE,
+    PROFILE_DIR,
+    PROFILE_SAMPLE_RATE,
     SERVER_HOST,
     SERVER_PORT,
+    ROLES,
+    SHUTDOWN_TIMEOUT,
     REDIRECT_URI,
     SPOTIFY_CLIENT_ID,
+    SPOTIFY_BREAKER_FAILURE_RATE,
+    SPOTIFY_BREAKER_MIN_CALLS,
+    SPOTIFY_BREAKER_OPEN_SECONDS,
+    SPOTIFY_BREAKER_WINDOW,
     SPOTIFY_CLIENT_SECRET,
+    SPOTIFY_QUOTA_BURST,
+    SPOTIFY_QUOTA_RATE,
+    STARTUP_PROFILE,
+    TOKEN_REFRESH_BATCH,
+    TOKEN_REFRESH_INTERVAL,
+    TOKEN_REFRESH_WINDOW,
+    TOKEN_REFRESH_WORKERS,
+    TRACE_SLOW_MS,
+    UPDATE_QUEUE_SIZE,
+    UPDATE_WORKERS,
+    WARMUP_MAX_PENDING,
+    WARMUP_REQUEST_BUDGET,
+    WARMUP_WORKERS,
 )
 
+if TYPE_CHECKING:
+    import requests
+    from flask import Flask
+    from spotipy import Spotify
+
+    from api.services.spotify_service import SpotifyHandler
+    from api.services.warmup_service import WarmupService
+    from bot.telegram_bot import NotifyTelegramBot
+
 
 class Server(threading.Thread):
     def __init__(
         self,
-        bot: NotifyTelegramBot,
+        bot: "NotifyTelegramBot",
+        warmup: Optional["WarmupService"] = None,
+        login_workers: int = LOGIN_WORKERS,
         server_host: str = SERVER_HOST,
         server_port: int = SERVER_PORT,
     ) -> None:
+        # flask and requests are only needed once the web server is started
+        import requests
+        from flask import Flask, render_template, request
+
         threading.Thread.__init__(self)
         self.kill_received = False
-        self.app: Flask = Flask(__name__)
+        self.app: "Flask" = Flask(__name__)
         self.server_host: str = server_host
         self.server_port: int = server_port
-        self.bot: NotifyTelegramBot = bot
+        self.bot: "NotifyTelegramBot" = bot
         self.database: DatabaseHandler = self.bot.database
-        self.spotify: SpotifyHandler = self.bot.spotify
+        self.spotify: "SpotifyHandler" = self.bot.spotify
+        self.warmup: Optional["WarmupService"] = warmup
+        self.login_executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=login_workers, thread_name_prefix="login"
+        )
+        self.session: "requests.Session" = requests.Session()
 
         @self.app.errorhandler(Exception)
         def handle_error(e) -> Any:
@@ -48,6 +113,10 @@ class Server(threading.Thread):
         def homepage() -> Any:
             return render_template("homepage.html")
 
+        @self.app.route("/health")
+        def health() -> Any:
+            return {"status": "ok", "role": "web"}
+
         @self.app.route("/callback")
         def callback() -> Any:
             try:
@@ -56,50 +125,11 @@ class Server(threading.Thread):
                 if error:
                     return render_template("homepage.html", message="denied")
 
-                # handle authorization code
+                # handle authorization code, the slow part finishes in the background
                 code: str = request.args.get("code")
-                if code:
-                    # exchange authorization code for an access token
-                    token_endpoint: str = "https://accounts.spotify.com/api/token"
-                    client_id: str = SPOTIFY_CLIENT_ID
-                    client_secret: str = SPOTIFY_CLIENT_SECRET
-                    redirect_uri: str = REDIRECT_URI
-                    params: List[str] = {
-                        "grant_type": "authorization_code",
-                        "code": code,
-                        "redirect_uri": redirect_uri,
-                        "client_id": client_id,
-                        "client_secret": client_secret,
-                    }
-                    response: str = requests.post(token_endpoint, data=params)
-                    response_data: str = response.json()
-
-                    telegram_user_id: str = request.args.get("state")
-
-                    refresh_token: str = response_data.get("refresh_token")
-                    access_token: str = response_data.get("access_token")
-
-                    spotify_sp: Spotify = self.spotify.get_user_sp(access_token)
-                    spotify_user_display: str = spotify_sp.current_user()[
-                        "display_name"
-                    ]
-                    spotify_user_id: str = spotify_sp.current_user()["id"]
-
-                    # store the access token in the database
-                    def update_table() -> None:
-                        self.database.cursor.execute(
-                            "INSERT INTO users (id, telegram_user_id, spotify_user_display, spotify_user_id, refresh_token, access_token) VALUES (?, ?, ?, ?, ?, ?)",
-                            (
-                                None,
-                                telegram_user_id,
-                                spotify_user_display,
-                                spotify_user_id,
-                                refresh_token,
-                                access_token,
-                            ),
-                        )
-
-                    self.database.process(update_table)
+                telegram_user_id: str = request.args.get("state")
+                if code and telegram_user_id:
+                    self.login_executor.submit(self.complete_login, code, int(telegram_user_id))
 
                     return render_template("homepage.html", message="success")
 
@@ -112,6 +142,63 @@ class Server(threading.Thread):
     def __do_nothing(self) -> None:
         pass
 
+    def complete_login(self, code: str, telegram_user_id: int) -> None:
+        try:
+            with tracer.trace("login", user=telegram_user_id):
+                # exchange authorization code for an access token
+                response_data: Dict[str, Any] = self.session.post(
+                    "https://accounts.spotify.com/api/token",
+                    data={
+                        "grant_type": "authorization_code",
+                        "code": code,
+                        "redirect_uri": REDIRECT_URI,
+                        "client_id": SPOTIFY_CLIENT_ID,
+                        "client_secret": SPOTIFY_CLIENT_SECRET,
+                    },
+                    timeout=10,
+                ).json()
+
+                refresh_token: str = response_data.get("refresh_token")
+                access_token: str = response_data.get("access_token")
+                token_expires_at: float = time.time() + response_data.get("expires_in", 0)
+
+                spotify_sp: "Spotify" = self.spotify.get_user_sp(access_token, telegram_user_id)
+                spotify_user: Dict[str, Any] = spotify_sp.current_user()
+
+                self.database.add_user(
+                    telegram_user_id=telegram_user_id,
+                    spotify_user_display=spotify_user["display_name"],
+                    spotify_user_id=spotify_user["id"],
+                    refresh_token=refresh_token,
+                    access_token=access_token,
+                    token_expires_at=token_expires_at,
+                )
+                # the login may have linked a different Spotify account than the cached one
+                self.spotify.forget_user(telegram_user_id)
+
+                # the user's first commands shouldn't start with cold caches, when the
+                # bot runs in another process it picks the user up from the warm-up queue
+                if self.warmup is not None:
+                    self.warmup.schedule(telegram_user_id, access_token)
+                else:
+                    self.database.queue_warmup(telegram_user_id)
+
+                self.bot.bot.send_message(
+                    telegram_user_id,
+                    f"You're logged in as {spotify_user['display_name']}! Send /help to see what I can do.",
+                )
+
+        except Exception as e:
+            print(f"An error occurred when trying to authenticate the user: {e}")
+
+            try:
+                self.bot.bot.send_message(
+                    telegram_user_id,
+                    "Something went wrong linking your Spotify account... Please try /login again.",
+                )
+            except Exception as e:
+                print(f"Error notifying user {telegram_user_id} about a failed login: {e}")
+
     def start_listening(self) -> None:
         try:
             print(f"Server is up and running!")
@@ -125,39 +212,169 @@ class Server(threading.Thread):
             self.start_listening()
 
 
-def shutdown_handler(sig, frame):
+def shutdown_handler(sig, frame, bot: Optional["NotifyTelegramBot"] = None, poller: Optional[threading.Thread] = None):
     print("Shutting down Notify...")
+
+    if bot is not None:
+        bot.stop()
+        bot.bot.stop_polling()
+    if poller is not None:
+        poller.join(timeout=SHUTDOWN_TIMEOUT)
+
     sys.exit(0)
 
 
+def check_health(role: str) -> bool:
+    if role == "web":
+        from urllib.request import urlopen
+
+        try:
+            with urlopen(f"http://127.0.0.1:{SERVER_PORT}/health", timeout=5) as response:
+                return response.status == 200
+        except OSError:
+            return False
+
+    return heartbeat_is_fresh(role, HEALTH_MAX_AGE)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run Notify or one of its roles.")
+    subparsers = parser.add_subparsers(dest="role")
+
+    subparsers.add_parser("all", help="Run the bot, the web server and the poller in one process")
+    subparsers.add_parser("bot", help="Answer Telegram commands and callbacks")
+    subparsers.add_parser("web", help="Serve the homepage and the Spotify login callback")
+    subparsers.add_parser("poller", help="Check tracked playlists for changes")
+    health_parser = subparsers.add_parser("health", help="Exit with 0 if the given role is healthy")
+    health_parser.add_argument("target", choices=ROLES)
+
+    args: argparse.Namespace = parser.parse_args()
+    if args.role is None:
+        args.role = NOTIFY_ROLE
+
+    return args
+
+
 def main():
-    signal.signal(signal.SIGINT, shutdown_handler)
+    args: argparse.Namespace = parse_args()
+
+    if args.role == "health":
+        sys.exit(0 if check_health(args.target) else 1)
+
+    # spotipy, telebot and requests load only once a role actually runs,
+    # so health checks stay cheap
+    from api.services.spotify_service import SpotifyHandler
+    from api.services.token_refresher import TokenRefresher
+    from api.services.warmup_service import WarmupService
+    from bot.telegram_bot import NotifyTelegramBot
+
+    role: str = args.role
+    startup = StartupProfile(STARTED_AT, enabled=STARTUP_PROFILE)
+    startup.mark("imports")
+    startup.check_budget("imports", IMPORT_TIME_BUDGET_MS)
+
+    tracer.configure(
+        slow_threshold_ms=TRACE_SLOW_MS,
+        profile_sample_rate=PROFILE_SAMPLE_RATE,
+        profile_dir=PROFILE_DIR,
+    )
 
-    database_handler = DatabaseHandler(NOTIFY_DB)
+    database_handler = DatabaseHandler(NOTIFY_DB, batch_size=NOTIFY_BATCH_SIZE, timeout=DB_BUSY_TIMEOUT)
+    database_handler.create_tables()
     spotify_handler = SpotifyHandler(
         client_id=SPOTIFY_CLIENT_ID,
         client_secret=SPOTIFY_CLIENT_SECRET,
         redirect_uri=REDIRECT_URI,
         scope="user-read-private user-read-currently-playing user-read-recently-played user-top-read playlist-read-private playlist-read-collaborative user-library-read",
+        profile_ttl=LISTENING_PROFILE_TTL,
+        library_ttl=PLAYLIST_LIBRARY_TTL,
+        breaker=CircuitBreaker(
+            failure_rate_threshold=SPOTIFY_BREAKER_FAILURE_RATE,
+            minimum_calls=SPOTIFY_BREAKER_MIN_CALLS,
+            window_size=SPOTIFY_BREAKER_WINDOW,
+            open_seconds=SPOTIFY_BREAKER_OPEN_SECONDS,
+        ),
+        validators=ValidatorCache(HTTP_CACHE_DB, max_age=HTTP_CACHE_MAX_AGE, timeout=DB_BUSY_TIMEOUT),
+        catalog=Catalog(max_bytes=CATALOG_MAX_BYTES),
+        quota=QuotaScheduler(rate=SPOTIFY_QUOTA_RATE, burst=SPOTIFY_QUOTA_BURST),
     )
 
     bot = NotifyTelegramBot(
         bot_token=BOT_API_TOKEN,
         database=database_handler,
         spotify=spotify_handler,
+        update_workers=UPDATE_WORKERS,
+        update_queue_size=UPDATE_QUEUE_SIZE,
+        poll_interval=POLL_INTERVAL,
+        digest_window=DIGEST_WINDOW,
+        notify_limit=NOTIFY_LIMIT,
+        bulk_notify_limit=BULK_NOTIFY_LIMIT,
+        max_missed_checks=MAX_MISSED_CHECKS,
     )
-    server = Server(bot)
+    startup.mark("bot setup")
+
+    # warm caches are only useful in the process that answers commands
+    warmup_service: Optional[WarmupService] = None
+    if role in ("bot", "all"):
+        warmup_service = WarmupService(
+            spotify_handler,
+            workers=WARMUP_WORKERS,
+            request_budget=WARMUP_REQUEST_BUDGET,
+            max_pending=WARMUP_MAX_PENDING,
+        )
+
+    checks: List[Callable[[], bool]] = []
+
+    if role in ("web", "all"):
+        server = Server(bot, warmup=warmup_service)
+        server.daemon = True
+        server.start()
+        checks.append(server.is_alive)
+        startup.mark("server setup")
+
+    task_thread: Optional[threading.Thread] = None
+    if role in ("poller", "all"):
+        task_thread = threading.Thread(target=bot.notify_changes, daemon=True)
+        task_thread.start()
+        checks.append(task_thread.is_alive)
+
+    if role == "bot":
+        # logins completed by a separate web process are warmed up here
+        threading.Thread(
+            target=warmup_service.watch_queue,
+            args=(database_handler, bot.stop_event),
+            daemon=True,
+        ).start()
+
+    if role in ("bot", "all"):
+        # commands and poll items then find a fresh token in the database
+        token_refresher = TokenRefresher(
+            spotify_handler,
+            database_handler,
+            window=TOKEN_REFRESH_WINDOW,
+            interval=TOKEN_REFRESH_INTERVAL,
+            batch_size=TOKEN_REFRESH_BATCH,
+            workers=TOKEN_REFRESH_WORKERS,
+            is_quiet=bot.is_quiet,
+        )
+        threading.Thread(target=token_refresher.run, args=(bot.stop_event,), daemon=True).start()
+
+        bot.start()
+        checks.append(bot.is_alive)
 
-    server_thread = threading.Thread(target=server.start, daemon=True)
-    server_thread.start()
+    if role != "web":
+        Heartbeat(role).start(checks)
+    startup.report()
 
-    task_thread = threading.Thread(target=bot.notify_changes, daemon=True)
-    task_thread.start()
+    handle_shutdown = partial(shutdown_handler, bot=bot, poller=task_thread)
+    signal.signal(signal.SIGINT, handle_shutdown)
+    signal.signal(signal.SIGTERM, handle_shutdown)
 
     try:
-        bot.start()
+        while all(check() for check in checks):
+            bot.stop_event.wait(1)
     except KeyboardInterrupt:
-        shutdown_handler(None, None)
+        handle_shutdown(None, None)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the app runs from src/, where api, bot and config are top-level packages
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
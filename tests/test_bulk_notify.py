@@ -0,0 +1,171 @@
+from typing import Dict, List
+
+import pytest
+
+from api.models.spotify_models import PlaylistSummary
+from api.services.database_service import DatabaseHandler
+from bot.telegram_bot import NotifyTelegramBot
+
+USER = 1
+
+PLAYLISTS: Dict[str, PlaylistSummary] = {
+    playlist_id: PlaylistSummary(
+        id=playlist_id,
+        name=f"Playlist {playlist_id}",
+        url=f"https://open.spotify.com/playlist/{playlist_id}",
+        snapshot_id=f"{playlist_id}-snapshot",
+    )
+    for playlist_id in ("p1", "p2", "p3", "p4", "p5")
+}
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    database = DatabaseHandler("test.db")
+    database.create_tables()
+    database.add_user(USER, "user", "user", "refresh", "access")
+    return database
+
+
+@pytest.fixture
+def spotify(mocker):
+    spotify = mocker.Mock()
+    spotify.get_playlists_parallel.side_effect = lambda ids: {
+        playlist_id: PLAYLISTS.get(playlist_id) for playlist_id in ids
+    }
+    return spotify
+
+
+@pytest.fixture
+def make_bot(database, spotify, mocker):
+    mocker.patch("bot.telegram_bot.TeleBot")
+    mocker.patch("bot.telegram_bot.ChatDispatcher")
+
+    def make_bot(notify_limit: int = 10, bulk_notify_limit: int = 10) -> NotifyTelegramBot:
+        bot = NotifyTelegramBot(
+            bot_token="token",
+            database=database,
+            spotify=spotify,
+            notify_limit=notify_limit,
+            bulk_notify_limit=bulk_notify_limit,
+        )
+        bot.user_id = USER
+        bot.chat_id = USER
+        return bot
+
+    return make_bot
+
+
+def send(bot: NotifyTelegramBot, command: str, *playlists_ids: str) -> List[str]:
+    links: str = " ".join(f"https://open.spotify.com/playlist/{playlist_id}" for playlist_id in playlists_ids)
+    bot.message = type("Message", (), {"text": f"/{command} {links}"})()
+    bot.bot.send_message.reset_mock()
+
+    bot.manage_notify("add" if command == "notify" else "remove")
+
+    bot.bot.send_message.assert_called_once()
+    return bot.bot.send_message.call_args.args[1].split("\n")
+
+
+def tracked(database: DatabaseHandler) -> List[str]:
+    return sorted(database.get_notify_playlists_by_user(USER))
+
+
+def notify_row(database: DatabaseHandler, playlist_id: str) -> List[tuple]:
+    def logic() -> List[tuple]:
+        database.cursor.execute(
+            "SELECT snapshot_id, active, missed_checks FROM notify WHERE telegram_user_id = ? AND playlist_id = ?",
+            (USER, playlist_id),
+        )
+        return database.cursor.fetchall()
+
+    return database.process(logic)
+
+
+def test_adds_every_valid_playlist(make_bot, database):
+    summary: List[str] = send(make_bot(), "notify", "p1", "p2")
+
+    assert summary == ["Now tracking:", "- Playlist p1", "- Playlist p2"]
+    assert tracked(database) == ["p1", "p2"]
+
+
+def test_duplicates_are_reported_as_already_tracked(make_bot, database, spotify):
+    database.add_notify(USER, "p1", "old-snapshot")
+
+    summary: List[str] = send(make_bot(), "notify", "p1", "p2", "p2")
+
+    assert summary == [
+        "Now tracking:",
+        "- Playlist p2",
+        "Already tracking 1 of the playlists you sent.",
+    ]
+    # tracked playlists and repeated links aren't validated again
+    spotify.get_playlists_parallel.assert_called_once_with(["p2"])
+    assert tracked(database) == ["p1", "p2"]
+    assert notify_row(database, "p1") == [("old-snapshot", 1, 0)]
+
+
+def test_invalid_ids_are_counted_and_not_stored(make_bot, database):
+    summary: List[str] = send(make_bot(), "notify", "p1", "missing", "gone")
+
+    assert summary == [
+        "Now tracking:",
+        "- Playlist p1",
+        "2 of the links are not valid playlists or don't exist.",
+    ]
+    assert tracked(database) == ["p1"]
+
+
+def test_playlists_over_the_limit_are_skipped(make_bot, database):
+    database.add_notify(USER, "p1", "p1-snapshot")
+
+    summary: List[str] = send(make_bot(notify_limit=3), "notify", "p2", "p3", "p4", "p5")
+
+    assert summary == [
+        "Now tracking:",
+        "- Playlist p2",
+        "- Playlist p3",
+        "You can only track up to 3 playlists at a time, so these were skipped:",
+        "- Playlist p4",
+        "- Playlist p5",
+    ]
+    assert tracked(database) == ["p1", "p2", "p3"]
+
+
+def test_only_the_first_links_are_checked(make_bot, database, spotify):
+    summary: List[str] = send(make_bot(bulk_notify_limit=2), "notify", "p1", "p2", "p3")
+
+    assert summary == [
+        "Now tracking:",
+        "- Playlist p1",
+        "- Playlist p2",
+        "Only the first 2 new links in a message are checked.",
+    ]
+    spotify.get_playlists_parallel.assert_called_once_with(["p1", "p2"])
+
+
+def test_inactive_subscription_is_reactivated(make_bot, database):
+    database.add_notify(USER, "p1", "old-snapshot")
+    with database.batch() as batch:
+        batch.record_miss(USER, "p1", 0)
+        batch.deactivate_notify(USER, "p1")
+    assert tracked(database) == []
+
+    summary: List[str] = send(make_bot(), "notify", "p1")
+
+    assert summary == ["Now tracking:", "- Playlist p1"]
+    assert notify_row(database, "p1") == [("p1-snapshot", 1, 0)]
+
+
+def test_removes_only_tracked_playlists(make_bot, database):
+    database.add_notify(USER, "p1", "p1-snapshot")
+    database.add_notify(USER, "p2", "p2-snapshot")
+
+    summary: List[str] = send(make_bot(), "removenotify", "p1", "p3")
+
+    assert summary == [
+        "Stopped tracking 1 playlist.",
+        "You weren't tracking 1 of the playlists you sent.",
+    ]
+    assert tracked(database) == ["p2"]
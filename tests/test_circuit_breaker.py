@@ -0,0 +1,93 @@
+import pytest
+
+from api.helpers import circuit_breaker
+from api.helpers.circuit_breaker import CircuitBreaker
+
+
+@pytest.fixture
+def clock(mocker):
+    clock = mocker.patch.object(circuit_breaker, "time")
+    clock.monotonic.return_value = 1000.0
+    return clock
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker(failure_rate_threshold=0.5, minimum_calls=4, window_size=4, open_seconds=60)
+
+
+def trip(breaker):
+    for _ in range(breaker.minimum_calls):
+        breaker.record_failure()
+
+
+def test_stays_closed_below_minimum_calls(breaker):
+    for _ in range(breaker.minimum_calls - 1):
+        breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+
+
+def test_opens_once_failure_rate_reaches_threshold(breaker):
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    assert breaker.retry_after() == 60
+
+
+def test_stays_closed_below_failure_rate(breaker):
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_allows_a_single_trial(breaker, clock):
+    trip(breaker)
+    clock.monotonic.return_value += 59
+    assert not breaker.allow_request()
+
+    clock.monotonic.return_value += 1
+
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.retry_after() == 0
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+
+def test_half_open_success_closes_the_circuit(breaker, clock):
+    trip(breaker)
+    clock.monotonic.return_value += 60
+    assert breaker.allow_request()
+
+    breaker.record_success()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request()
+    # the failures that opened it don't count against the fresh window
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_failure_reopens_the_circuit(breaker, clock):
+    trip(breaker)
+    clock.monotonic.return_value += 60
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow_request()
+    assert breaker.retry_after() == 60
+
+    clock.monotonic.return_value += 60
+    assert breaker.allow_request()
@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import Counter
+from typing import Dict, List
+
+import pytest
+
+from api.helpers import quota
+from api.helpers.quota import QuotaScheduler
+
+LANES = (QuotaScheduler.INTERACTIVE, QuotaScheduler.WARMUP, QuotaScheduler.BACKGROUND)
+
+
+@pytest.fixture
+def clock(mocker):
+    clock = mocker.patch.object(quota, "time")
+    clock.monotonic.return_value = 1000.0
+    return clock
+
+
+class Contention:
+    # keeps the given lanes waiting and hands out one token at a time,
+    # so every grant is decided with all of them in the queue
+    def __init__(self, scheduler: QuotaScheduler, clock) -> None:
+        self.scheduler: QuotaScheduler = scheduler
+        self.clock = clock
+        self.grants: List[str] = []
+        self.stop_event = threading.Event()
+        self.threads: Dict[str, threading.Thread] = {}
+        self.scheduler.tokens = 0
+
+    def start(self, *lanes: str) -> None:
+        for lane in lanes:
+            thread = threading.Thread(target=self.__work, args=(lane,), daemon=True)
+            self.threads[lane] = thread
+            thread.start()
+
+    def __work(self, lane: str) -> None:
+        while not self.stop_event.is_set():
+            self.scheduler.acquire(lane)
+            self.grants.append(lane)
+
+    def __wait_for(self, condition) -> None:
+        deadline: float = time.monotonic() + 5
+        while not condition():
+            assert time.monotonic() < deadline, "scheduler threads stopped making progress"
+            time.sleep(0.001)
+
+    def grant(self, count: int) -> List[str]:
+        granted: int = len(self.grants)
+
+        for _ in range(count):
+            self.__wait_for(lambda: all(self.scheduler.waiting[lane] for lane in self.threads))
+            with self.scheduler.condition:
+                self.clock.monotonic.return_value += 1 / self.scheduler.rate
+                self.scheduler.condition.notify_all()
+            granted += 1
+            self.__wait_for(lambda: len(self.grants) >= granted)
+
+        return self.grants[granted - count:granted]
+
+    def close(self) -> None:
+        self.stop_event.set()
+        with self.scheduler.condition:
+            self.scheduler.burst = len(self.threads)
+            self.clock.monotonic.return_value += len(self.threads) / self.scheduler.rate
+            self.scheduler.condition.notify_all()
+        for thread in self.threads.values():
+            thread.join(timeout=5)
+
+
+@pytest.fixture
+def contention(clock):
+    contention = Contention(QuotaScheduler(rate=1, burst=1), clock)
+    yield contention
+    contention.close()
+
+
+def test_lanes_share_the_quota_by_weight(contention):
+    contention.start(*LANES)
+
+    grants: List[str] = contention.grant(120)
+
+    assert Counter(grants) == {
+        QuotaScheduler.INTERACTIVE: 80,
+        QuotaScheduler.WARMUP: 30,
+        QuotaScheduler.BACKGROUND: 10,
+    }
+
+
+def test_no_lane_is_starved(contention):
+    contention.start(*LANES)
+
+    grants: List[str] = contention.grant(120)
+
+    for start in range(0, len(grants) - 12 + 1):
+        assert set(grants[start:start + 12]) == set(LANES)
+
+
+def test_idle_lane_does_not_bank_the_time_it_sat_out(contention):
+    contention.start(QuotaScheduler.BACKGROUND)
+    contention.grant(24)
+
+    contention.start(QuotaScheduler.INTERACTIVE, QuotaScheduler.WARMUP)
+    grants: List[str] = contention.grant(24)
+
+    # with the idle time banked, interactive and warm-up would take the next 250 grants
+    assert QuotaScheduler.BACKGROUND in grants[:14]
+    assert Counter(grants)[QuotaScheduler.INTERACTIVE] <= 16
+
+
+def test_interactive_busy_while_a_request_waits(contention):
+    assert not contention.scheduler.interactive_busy()
+
+    contention.start(QuotaScheduler.INTERACTIVE)
+    contention.grant(1)
+
+    assert contention.scheduler.interactive_busy()
+
+
+def test_interactive_busy_follows_recent_demand(clock):
+    scheduler = QuotaScheduler(rate=10, burst=100, demand_window=10)
+
+    for _ in range(49):
+        scheduler.acquire(QuotaScheduler.INTERACTIVE)
+    assert not scheduler.interactive_busy()
+
+    scheduler.acquire(QuotaScheduler.INTERACTIVE)
+    assert scheduler.interactive_busy()
+
+    # background work doesn't count as interactive demand
+    for _ in range(50):
+        scheduler.acquire(QuotaScheduler.BACKGROUND)
+    clock.monotonic.return_value += 11
+    assert not scheduler.interactive_busy()
@@ -0,0 +1,87 @@
+import pytest
+import requests
+from spotipy import SpotifyException
+
+from api.helpers.circuit_breaker import CircuitBreaker
+from api.services.spotify_service import NotifySpotify, SpotifyUnavailableError
+
+PLAYLIST_URL = "https://api.spotify.com/v1/playlists/abc"
+
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker(failure_rate_threshold=0.5, minimum_calls=2, window_size=2, open_seconds=60)
+
+
+@pytest.fixture
+def sp(breaker):
+    return NotifySpotify(auth="token", breaker=breaker, retries=0, status_retries=0)
+
+
+def test_success_is_recorded(sp, breaker, requests_mock):
+    requests_mock.get(PLAYLIST_URL, json={"id": "abc"})
+
+    assert sp.playlist("abc")["id"] == "abc"
+    assert list(breaker.outcomes) == [False]
+
+
+@pytest.mark.parametrize("status", [500, 502, 503])
+def test_server_errors_mean_spotify_is_unavailable(sp, breaker, requests_mock, status):
+    requests_mock.get(PLAYLIST_URL, status_code=status)
+
+    with pytest.raises(SpotifyUnavailableError):
+        sp.playlist("abc")
+    assert list(breaker.outcomes) == [True]
+
+
+def test_exhausted_retries_mean_spotify_is_unavailable(sp, breaker, requests_mock):
+    request = requests.Request("GET", PLAYLIST_URL).prepare()
+    requests_mock.get(PLAYLIST_URL, exc=requests.exceptions.RetryError("too many 503s", request=request))
+
+    with pytest.raises(SpotifyUnavailableError):
+        sp.playlist("abc")
+    assert list(breaker.outcomes) == [True]
+
+
+def test_connection_errors_mean_spotify_is_unavailable(sp, breaker, requests_mock):
+    requests_mock.get(PLAYLIST_URL, exc=requests.exceptions.ConnectionError)
+
+    with pytest.raises(SpotifyUnavailableError):
+        sp.playlist("abc")
+    assert list(breaker.outcomes) == [True]
+
+
+def test_not_found_is_a_healthy_answer(sp, breaker, requests_mock):
+    requests_mock.get(PLAYLIST_URL, status_code=404, json={"error": {"status": 404, "message": "Not found"}})
+
+    with pytest.raises(SpotifyException) as excinfo:
+        sp.playlist("abc")
+    assert excinfo.value.http_status == 404
+    assert list(breaker.outcomes) == [False]
+
+
+def test_open_circuit_skips_the_request(sp, breaker, requests_mock):
+    requests_mock.get(PLAYLIST_URL, status_code=503)
+    for _ in range(2):
+        with pytest.raises(SpotifyUnavailableError):
+            sp.playlist("abc")
+
+    with pytest.raises(SpotifyUnavailableError, match="circuit is open"):
+        sp.playlist("abc")
+    assert requests_mock.call_count == 2
+
+
+def test_unexpected_error_on_trial_call_reopens_the_circuit(sp, breaker, requests_mock, mocker):
+    clock = mocker.patch("api.helpers.circuit_breaker.time")
+    clock.monotonic.return_value = 1000.0
+    requests_mock.get(PLAYLIST_URL, status_code=503)
+    for _ in range(2):
+        with pytest.raises(SpotifyUnavailableError):
+            sp.playlist("abc")
+
+    clock.monotonic.return_value += 60
+    requests_mock.get(PLAYLIST_URL, exc=requests.exceptions.ChunkedEncodingError)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        sp.playlist("abc")
+
+    assert breaker.state == CircuitBreaker.OPEN